@@ -0,0 +1,10 @@
+REM ********* Set Variable Values **************
+set pPath="C:\Program Files\ArcGIS\Pro\bin\Python\envs\arcgispro-py3\python.exe" 
+set mdcsPath=C:\Image_Mgmt_Workflows\MDCS\arcgis-sentinel-2-cog-ag-fields
+set mdPath=C:\data\sentinel-2-l2a\SanLuisValley.gdb\SanLuisValley
+
+REM Keeps the MRF cache within budget, schedule it (e.g. daily with Task Scheduler) on each image server.
+%pPath%  "%mdcsPath%\scripts\MDCS.py" -i:"%mdcsPath%\Parameter\Config\DEA.xml" -m:"%mdPath%" -c:cacheMaintenance -p:500$cache_budget_gb -p:lru$cache_policy -p:24$cache_grace_hours
+
+REM Cache telemetry (Parameter\Cache\telemetry.json and mrf_cache.prom), point cache_metrics_prom at the node_exporter textfile directory to scrape it.
+%pPath%  "%mdcsPath%\scripts\MDCS.py" -i:"%mdcsPath%\Parameter\Config\DEA.xml" -m:"%mdPath%" -c:cacheTelemetry
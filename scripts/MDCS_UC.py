@@ -29,15 +29,27 @@ import urllib
 import json
 import csv
 import requests
+import math
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 #from satsearch import Search
 from pystac_client import Client
+from pystac_client.conformance import ConformanceClasses
 from typing import Any, Dict
+import sentinelLib
+import sentinelBench
 
 
 class UserCode:
 
     def __init__(self):
-        pass    # initialize variables that need to be shared between multiple user commands.
+        self.m_stac_local = threading.local()    # per worker thread STAC client used by searchPages.
+        self.m_wgs_sr = None                     # shared WGS84 spatial reference for scene footprints.
+        self.m_fields_supported = None           # STAC fields extension support of the endpoint, probed once.
+        self.m_scoring = None                    # sentinelLib.ScoringEngine compiled from the <Scoring> config block.
+        self.m_mrf = None                        # sentinelLib.MRFTemplate for the caching MRF descriptors.
+        self.m_source_profile = None             # sentinelLib.SourceProfile selected by <source_profile>.
 
     def sample00(self, data):
         base = data['base']         # using Base class for its XML specific common functions. (getXMLXPathValue, getXMLNodeValue, getXMLNode)
@@ -137,6 +149,7 @@ class UserCode:
             fileFieldDef.append({fld_lst[10]:['Text','#','#',80]})       #RasterProxy_BB_Values
             fileFieldDef.append({fld_lst[11]:['Long','#','#','#']})      #Q
             fileFieldDef.append({fld_lst[12]:['Long','#','#','#']})     #Best
+            fileFieldDef.append({fld_lst[13]:['Float','#','#','#']})    #NoDataPct
             try:
                 log.Message(("Adding Field to " + os.path.basename(featClass) + "..."),log.const_general_text)
                 for fld in fileFieldDef:
@@ -161,7 +174,7 @@ class UserCode:
             return False
 
 # add field band raster
-    def addFields(self,data,featClass,fld_lst):
+    def addFields(self,data,featClass,fld_lst,rasterLength=5000):
         log = data['log']
         try:
             fileFieldDef = []
@@ -174,7 +187,7 @@ class UserCode:
             fileFieldDef.append({fld_lst[7]:['Long','#','#','#']})      #NumDate
             fileFieldDef.append({fld_lst[8]:['Long','#','#','#']})      #Q
             fileFieldDef.append({fld_lst[9]:['Long','#','#','#']})      #Best
-            fileFieldDef.append({fld_lst[10]:['Text','#','#',5000]})    #Raster
+            fileFieldDef.append({fld_lst[10]:['Text','#','#',rasterLength]})    #Raster
             fileFieldDef.append({fld_lst[11]:['Text','#','#',10]})      #Tag
 
 
@@ -200,130 +213,85 @@ class UserCode:
             return False
 
 
-    def embedMRF(self,data,cache_loc,tile_string,maxX,maxY,minX,minY,srs_string,bands):
+    def getSourceProfiles(self, data):
+        # built-in profiles (sentinelLib.CSOURCE_PROFILES) updated by <SourceProfiles><Profile name="..."><Scheme>...
+        # </Scheme>...</Profile></SourceProfiles>, a profile given there replaces the built-in one of the same name.
+        profiles = dict(sentinelLib.CSOURCE_PROFILES)
+        nodes = data['mdcs'].getElementsByTagName('SourceProfiles')
+        if nodes:
+            for node in nodes[0].getElementsByTagName('Profile'):
+                values = {}
+                for child in node.childNodes:
+                    if child.nodeType == child.ELEMENT_NODE and child.firstChild is not None and child.firstChild.data.strip():
+                        values[child.nodeName] = child.firstChild.data.strip()
+                profiles[node.getAttribute('name')] = values
+        return dict((name, sentinelLib.SourceProfile.fromDict(name, values)) for name, values in profiles.items())
+
+    def getSourceProfile(self, data):
+        # the <source_profile> used for the COG sources (default vsicurl, the original /vsicurl/ without options). Its
+        # GDAL options are set in the process environment once, the caching MRFs read by this process (AR, prewarm)
+        # pick them up from there. The image server reading the descriptors needs the same options in its environment.
+        if self.m_source_profile is None:
+            name = self.getConfigValue(data, 'source_profile', 'vsicurl')
+            profiles = self.getSourceProfiles(data)
+            if name not in profiles:
+                raise ValueError('Unknown source profile ' + name + ', defined: ' + ', '.join(sorted(profiles)))
+            self.m_source_profile = profiles[name]
+            self.m_source_profile.apply()
+            data['log'].Message(("Source profile " + name),data['log'].const_general_text)
+            for key, value in sorted(self.m_source_profile.config().items()):
+                data['log'].Message(("  {}={}".format(key, value)),data['log'].const_general_text)
+        return self.m_source_profile
+
+    def getMRFTemplate(self, data):
+        # cache roots (<mrf_cache_root>, 'folder[*weight];...'), the URL prefix stripped to form the cache key
+        # (<mrf_cache_strip>, by default sentinelLib.CLEGACY_CACHE_STRIP, the cache paths of the original descriptors,
+        # URLs without that prefix lose the scheme and host), the layout (<mrf_cache_layout> mirror/hash) and the
+        # source profile come from the config, band sizes from sentinelLib.BAND_INFO.
+        if self.m_mrf is None:
+            self.m_mrf = sentinelLib.MRFTemplate(self.getConfigValue(data, 'mrf_cache_root', r"C:/mrfcache/cachingmrf/"),
+                                                 self.getConfigValue(data, 'mrf_cache_strip', sentinelLib.CLEGACY_CACHE_STRIP), None,
+                                                 self.getConfigValue(data, 'mrf_cache_layout', 'mirror'),
+                                                 self.getSourceProfile(data))
+        return self.m_mrf
+
+    def embedMRF(self,data,tile_string,maxX,maxY,minX,minY,srs_string,bands):
         log = data['log']
         try:
-            tile_url = cache_loc + tile_string[55:]
-            cache_path = os.path.join(tile_url,bands)
-            bandpath_amzn = tile_string+bands+".tif"
-            if bands in ["B01","B09","AOT"]:
-                try:
-                    #create template for 10m resolution and write to a file
-                    cachingMRF = \
-                            '<MRF_META>\n'  \
-                            '  <CachedSource>\n'  \
-                            '    <Source>/vsicurl/{0}</Source>\n'  \
-                            '  </CachedSource>\n'  \
-                            '  <Raster>\n'  \
-                            '    <Size c="1" x="1830" y="1830"/>\n'  \
-                            '    <PageSize c="1" x="512" y="512"/>\n'  \
-                            '    <Compression>LERC</Compression>\n'  \
-                            '    <DataType>UInt16</DataType>\n'  \
-                            '  <DataFile>{1}.mrf_cache</DataFile><IndexFile>{1}.mrf_cache</IndexFile></Raster>\n'  \
-                            '  <Rsets model="uniform" scale="2"/>\n'  \
-                            '  <GeoTags>\n'  \
-                            '    <BoundingBox maxx="{2}" maxy="{3}" minx="{4}" miny="{5}"/>\n'  \
-                            '    <Projection>{6}</Projection>\n'  \
-                            '  </GeoTags>\n'  \
-                            '  <Options>V2=ON</Options>\n'  \
-                            '</MRF_META>\n'.format(bandpath_amzn,cache_path,maxX,maxY,minX,minY,srs_string)
-
-                except Exception as exp:
-                    log.Message(str(exp),log.const_critical_text)
-
-            elif bands in ["B05","B06","B07","B8A","B11","B12","SCL"]:
-                try:
-                    #template for 20m resolution and write to a file
-                    cachingMRF= \
-                            '<MRF_META>\n'  \
-                            '  <CachedSource>\n'  \
-                            '    <Source>/vsicurl/{0}</Source>\n'  \
-                            '  </CachedSource>\n'  \
-                            '  <Raster>\n'  \
-                            '    <Size c="1" x="5490" y="5490"/>\n'  \
-                            '    <PageSize c="1" x="512" y="512"/>\n'  \
-                            '    <Compression>LERC</Compression>\n'  \
-                            '    <DataType>UInt16</DataType>\n'  \
-                            '  <DataFile>{1}.mrf_cache</DataFile><IndexFile>{1}.mrf_cache</IndexFile></Raster>\n'  \
-                            '  <Rsets model="uniform" scale="2"/>\n'  \
-                            '  <GeoTags>\n'  \
-                            '    <BoundingBox maxx="{2}" maxy="{3}" minx="{4}" miny="{5}"/>\n'  \
-                            '    <Projection>{6}</Projection>\n'  \
-                            '  </GeoTags>\n'  \
-                            '  <Options>V2=ON</Options>\n'  \
-                            '</MRF_META>\n'.format(bandpath_amzn,cache_path,maxX,maxY,minX,minY,srs_string)
-
-                except Exception as exp:
-                    log.Message(str(exp),log.const_critical_text)
-
-            else:
-                try:
-                    #template for 60m resolution and write to a file
-                    cachingMRF = \
-                            '<MRF_META>\n'  \
-                            '  <CachedSource>\n'  \
-                            '    <Source>/vsicurl/{0}</Source>\n'  \
-                            '  </CachedSource>\n'  \
-                            '  <Raster>\n'  \
-                            '    <Size c="1" x="10980" y="10980"/>\n'  \
-                            '    <PageSize c="1" x="512" y="512"/>\n'  \
-                            '    <Compression>LERC</Compression>\n'  \
-                            '    <DataType>UInt16</DataType>\n'  \
-                            '  <DataFile>{1}.mrf_cache</DataFile><IndexFile>{1}.mrf_cache</IndexFile></Raster>\n'  \
-                            '  <Rsets model="uniform" scale="2"/>\n'  \
-                            '  <GeoTags>\n'  \
-                            '    <BoundingBox maxx="{2}" maxy="{3}" minx="{4}" miny="{5}"/>\n'  \
-                            '    <Projection>{6}</Projection>\n'  \
-                            '  </GeoTags>\n'  \
-                            '  <Options>V2=ON</Options>\n'  \
-                            '</MRF_META>\n'.format(bandpath_amzn,cache_path,maxX,maxY,minX,minY,srs_string)
-
-                except Exception as exp:
-                    log.Message(str(exp),2)
-
-            return cachingMRF
+            return self.getMRFTemplate(data).render(tile_string,maxX,maxY,minX,minY,srs_string,bands)
 
         except Exception as exp:
             log.Message(str(exp),2)
 
-    def findBestTiles(self, data, input_fc):
+    def findBestTiles(self, data, input_fc, where_clause=None):
         log = data['log']
 
-        #update the Q and Best field
+        #update the Q and Best field, where_clause limits the rows that are read and rescored (None for all rows).
         try:
-            fld_lst1 =['AcquisitionDate','CloudCover','Q','Shape_Area','Best']    #Input feature class will not have the raster field and datatype_format field
-            uc = arcpy.da.UpdateCursor(input_fc,fld_lst1)   #Since the Q and Best of only new records is to be calculated.
             log.Message(("Calculating the Q and Best value..."),0)
-
-
-            for rows in uc:
-                acqDate = rows[0]
-                acqDate = str(acqDate).replace('-', '/')
-                year = int(acqDate.split()[0].split('/')[0])
-                month = int(acqDate.split()[0].split('/')[1])
-                day = int(acqDate.split()[0].split('/')[2])
-                cc = rows[1]
-                if cc == None:
-                    cc = 0    #
-                cloudCover = (cc/100.0) * 180 #( for the scenes which have cloud cover as 100 will be pushed down by 180 days )
-                aDt = datetime(year,month,day)
-                basedate  = datetime(1899, 12, 31)
-                datediff = aDt - basedate
-                aqdateFloat = float(datediff.days) + (float(datediff.seconds) / 86400)
-                #considering of area
-
-                area_equ_km = rows[3]/1000000 # ( Conversion in sqkm)
-                area_ratio = float (area_equ_km/12115.0)  #TileID = 20170211T144725_19NHB_0
-                if area_ratio <= 1.0 and area_ratio > 0.2:
-                    area_equ_date = -(60 - area_ratio*60)  #the higher the above ratio the lesser number of days the scene will be pushed by.The maximum number of days a tile will be pushed by is 60.
-                elif area_ratio <= 0.2:
-                    area_equ_date = -(600 - area_ratio*600) # (The max the smallest tile will be pushed by is 600 days)
-                else:
-                    area_equ_date = 0
-                rows[2] = ((100000 - aqdateFloat + cloudCover) - area_equ_date)
-                rows[4] = rows[2]  #Best value to have same value as Q
-                uc.updateRow(rows)
-            del uc
+            oidField = arcpy.Describe(input_fc).OIDFieldName
+            scoring = self.getScoringEngine(data)
+            fld_lst1 =['OID@','AcquisitionDate','CloudCover','SHAPE@AREA','Q','Best']
+            useNoData = scoring.uses('nodata') and len(arcpy.ListFields(input_fc, 'NoDataPct')) > 0
+            if useNoData:
+                fld_lst1.append('NoDataPct')
+            # the columns are loaded once and scored as arrays (sentinelLib.ScoringEngine), a missing cloud cover counts as 0.
+            arr = arcpy.da.FeatureClassToNumPyArray(input_fc, fld_lst1, where_clause,
+                                                    null_value={'CloudCover': 0, 'Q': -1, 'Best': -1, 'NoDataPct': 0})
+            if len(arr) == 0:
+                return True
+            scores = scoring.score(arr['AcquisitionDate'], arr['CloudCover'], arr['SHAPE@AREA'],
+                                   arr['NoDataPct'] if useNoData else None)
+            changed = sentinelLib.changedScores(arr['Q'], arr['Best'], scores)
+            log.Message(("{} of {} row(s) have new Q/Best values".format(len(changed), len(arr))),0)
+            newScores = dict(zip(arr['OID@'][changed].tolist(), scores[changed].tolist()))
+            for where in sentinelLib.inClauses(oidField, newScores.keys()):
+                with arcpy.da.UpdateCursor(input_fc, ['OID@','Q','Best'], where) as uc:
+                    for rows in uc:
+                        rows[1] = newScores[rows[0]]
+                        rows[2] = rows[1]  #Best value to have same value as Q
+                        uc.updateRow(rows)
+            return True
 
         except Exception as exp:
             log.Message(str(exp),3)
@@ -332,95 +300,11 @@ class UserCode:
 
     def readJson(self, data, url):
         log = data['log']
-        jsonValList = []
 
         try:
-            response = urllib.request.urlopen(url)
-
-            jsData = json.loads(response.read())
-
-            # A list of features and coordinate pairs
-            feature_info = jsData['geometry']['coordinates']
-
-            # A list that will hold each of the Polygon objects
-            features = []
-
-            wgs_sr = arcpy.SpatialReference(4326)
-
-
-            # Create Polygon objects based an the array of points
-            for feature in feature_info:
-                array = arcpy.Array([arcpy.Point(*coords) for coords in feature])
-                    # Add the first coordinate pair to the end to close polygon
-                array.append(array[0])
-
-            features=arcpy.Polygon(array,wgs_sr)
-            # features.projectAs(wm_sr)
-            jsonValList.append(features)
-
-
-            AcquisitionDate = jsData['properties']['datetime']
-            AcquisitionDate = AcquisitionDate[0:10]+' '+AcquisitionDate[11:19]
-
-            jsonValList.append(AcquisitionDate)
-
-            cloudcover = jsData['properties']['eo:cloud_cover']
-            jsonValList.append(cloudcover)
-
-            ProductName = jsData['id']
-            jsonValList.append(ProductName)
-
-            Productid = jsData['properties']['sentinel:product_id']
-            jsonValList.append(Productid)
-
-            #ProductURL = "http://sentinel-cogs.s3-us-west-2.amazonaws.com/sentinel-s2-l2a-cogs/" + ProductName[4:6]+'/'+ProductName[6]+'/'+ProductName[7:9]+'/'+ProductName[10:14]+'/'+str(int(ProductName[14:16]))+'/'+ProductName+'/'
-            ProductURL = (jsData['assets']['visual']['href'])[:-7]
-            jsonValList.append(ProductURL)
-
-            Constellation  = jsData['properties']['constellation']
-            jsonValList.append(Constellation)
-
-            srs  = jsData['properties']['proj:epsg']
-            jsonValList.append(srs)
-
-
-
-            NumDate  = AcquisitionDate[0:4]+AcquisitionDate[5:7]+AcquisitionDate[8:10]
-            jsonValList.append(NumDate)
-
-            min_X = str(jsData['bbox'][0])
-            min_Y = str(jsData['bbox'][1])
-            max_X = str(jsData['bbox'][2])
-            max_Y = str(jsData['bbox'][3])
-            Tile_BB_Values = min_X + ","+ min_Y + ","+ max_X + ","+ max_Y
-            jsonValList.append(Tile_BB_Values)
-
-
-            Shape = jsData['assets']['visual']['proj:shape'][0]
-            min_X = jsData['assets']['visual']['proj:transform'][2]
-            max_Y = jsData['assets']['visual']['proj:transform'][5]
-            Multipliers = jsData['assets']['visual']['proj:transform'][0]
-
-            max_X = min_X + Shape * Multipliers
-            min_Y = max_Y - Shape * Multipliers
-
-
-            RasterProxy_BB_Values = str(max_X) + ","+ str(max_Y) + ","+ str(min_X) + ","+ str(min_Y)
-            jsonValList.append(RasterProxy_BB_Values)
-
-
-            Q = 42572
-            jsonValList.append(Q)
-
-            Best = 542572
-            jsonValList.append(Best)
-
-
-
-            del AcquisitionDate,cloudcover,ProductName,ProductURL,srs,NumDate,Tile_BB_Values
-            del jsData,wgs_sr
-
-            return jsonValList
+            response = requests.get(url, timeout=30)
+            response.raise_for_status()
+            return self.readStac(data, response.json())
 
         except Exception as exp:
             log.Message(str(exp),2)
@@ -430,118 +314,412 @@ class UserCode:
 
     def readStac(self, data, stac):
         log = data['log']
-        jsonValList = []
 
         try:
+            item = stac if isinstance(stac, dict) else stac.to_dict()
+            batch = sentinelLib.buildSceneBatch([item])
+            for itemId, err in batch.errors:
+                log.Message(err,2)
+            if len(batch) == 0:
+                raise ValueError('Invalid STAC item {}'.format(item.get('id')))
+            return self.sceneRows(data, batch)[0]
 
-            jsData = stac
-
-            # A list of features and coordinate pairs
-            feature_info = jsData.geometry['coordinates']
-
-            # A list that will hold each of the Polygon objects
-            features = []
-
-            wgs_sr = arcpy.SpatialReference(4326)
-
-
-            # Create Polygon objects based an the array of points
-            for feature in feature_info:
-                array = arcpy.Array([arcpy.Point(*coords) for coords in feature])
-                    # Add the first coordinate pair to the end to close polygon
-                array.append(array[0])
-
-            features=arcpy.Polygon(array,wgs_sr)
-            # features.projectAs(wm_sr)
-            jsonValList.append(features)
-
-
-            AcquisitionDate = jsData.properties['datetime']
-            AcquisitionDate = AcquisitionDate[0:10]+' '+AcquisitionDate[11:19]
-
-            jsonValList.append(AcquisitionDate)
+        except Exception as exp:
+            log.Message(str(exp),2)
+            log.Message(("Unable to create a valid json ...Moving to the next grid"),2)
+            return False
 
-            cloudcover = jsData.properties['eo:cloud_cover']
-            jsonValList.append(cloudcover)
 
-            ProductName = jsData.id
-            jsonValList.append(ProductName)
+    def sceneRows(self, data, batch, reject=None):
+        # MasterTiles rows from a columnar scene batch, one spatial reference object is shared by all footprints.
+        # A scene whose footprint or score cannot be built is passed to reject(values, exp) and left out, the geometry
+        # replaced by its ring coordinates. Without reject the error is raised.
+        if self.m_wgs_sr is None:
+            self.m_wgs_sr = arcpy.SpatialReference(4326)
+        rows = []
+        bboxValues = batch.bbox.tolist()
+        proxyValues = batch.proxyBBox.tolist()
+        numDates = batch.numDate.tolist()
+        cloud = batch.cloud.tolist()
+        epsg = batch.epsg.tolist()
+        # Q/Best from the in-memory footprint, same values findBestTiles derives from Shape_Area.
+        scoring = self.getScoringEngine(data)
+        areas = sentinelLib.ringAreas(batch)
+        try:
+            scores = scoring.score(batch.datetime, batch.cloud, areas, batch.nodata).tolist()
+        except Exception:
+            if reject is None:
+                raise
+            scores = None       # scored one scene at a time below, a bad value then only costs its own scene.
+        nodata = [None if math.isnan(v) else v for v in batch.nodata.tolist()]
+        for i in range(len(batch)):
+            ring = batch.ring(i).tolist()
+            row = [ring, batch.acqDate[i], cloud[i], batch.id[i], batch.productId[i], batch.productUrl[i],
+                   batch.constellation[i], epsg[i], str(numDates[i]), sentinelLib.joinValues(bboxValues[i]),
+                   sentinelLib.joinValues(proxyValues[i]), None, None, nodata[i]]
+            try:
+                if scores is None:
+                    Q = int(scoring.score(batch.datetime[i:i + 1], batch.cloud[i:i + 1], areas[i:i + 1], batch.nodata[i:i + 1])[0])
+                else:
+                    Q = scores[i]
+                row[0] = arcpy.Polygon(arcpy.Array([arcpy.Point(x, y) for x, y in ring]), self.m_wgs_sr)
+                row[11] = Q
+                row[12] = Q     #Best value to have same value as Q
+            except Exception as exp:
+                if reject is None:
+                    raise
+                reject(row, exp)
+                continue
+            rows.append(row)
+        return rows
+
+
+    def bandRows(self, data, row, store=None):
+        # expand one MasterTiles row into its BandTiles rows, one caching MRF per band tagged with the band name.
+        # With a sentinelLib.DescriptorStore the MRF is written to the store and Raster only holds its path.
+        srs = 'EPSG:' + str(row[7])
+        coordinate = row[10].split(",")
+        JsonData = [row[0], row[1], row[2], row[3], row[4], row[6], row[7], row[8], row[11], row[12]]
+        rows = []
+        for band in sentinelLib.BANDS:
+            datareq = JsonData[:]
+            cachingmrf = self.embedMRF(data,row[5],coordinate[0],coordinate[1],coordinate[2],coordinate[3],srs,band)
+            if store is not None:
+                cachingmrf = store.put(cachingmrf)
+            datareq.append(cachingmrf)
+            datareq.append(band) #add to tag field.
+            rows.append(datareq)
+        return rows
 
-            Productid = jsData.properties['s2:product_uri']
-            jsonValList.append(Productid)
 
-            #ProductURL = "http://sentinel-cogs.s3-us-west-2.amazonaws.com/sentinel-s2-l2a-cogs/" + ProductName[4:6]+'/'+ProductName[6]+'/'+ProductName[7:9]+'/'+ProductName[10:14]+'/'+str(int(ProductName[14:16]))+'/'+ProductName+'/'
-            ProductURL = (jsData.assets['visual'].href)[:-7]
-            jsonValList.append(ProductURL)
+    def date_range(self, data,start, end, intv):
+        log = data['log']
+        datelist =[]
+        try:
+            start = datetime.strptime(start,"%Y-%m-%d").date()
+            end = datetime.strptime(end,"%Y-%m-%d").date()
+            diff = (end-start)//int(intv)
+            for i in range(int(intv)):
+                startdate = ((start + diff * i).strftime("%Y-%m-%d"))
+                endDate = ((start + diff * (i+1)).strftime("%Y-%m-%d"))
+                datelist.append(startdate+'/'+endDate)
+            return datelist
+            
+        except Exception as exp:
+            log.Message(str(exp),2)
+            log.Message(("Unable to create a valid date range"),2)
+            return False
 
-            Constellation  = jsData.properties['constellation']
-            jsonValList.append(Constellation)
 
-            srs  = jsData.properties['proj:epsg']
-            jsonValList.append(srs)
+    def getConfigValue(self, data, name, default):
+        base = data['base']
+        value = base.getXMLNodeValue(data['mdcs'], name)
+        if value == "#" or value.strip() == "":
+            return default
+        return value.strip()
+
+
+    def getScoringEngine(self, data):
+        # <Scoring><Weights><name>value</name>...</Weights><Define name="...">...</Define><Expression>...</Expression></Scoring>
+        # every part is optional, anything left out falls back to the original findBestTiles formula.
+        if self.m_scoring is not None:
+            return self.m_scoring
+        expression = sentinelLib.CSCORE_EXPRESSION
+        weights = {}
+        defines = None
+        nodes = data['mdcs'].getElementsByTagName('Scoring')
+        if nodes:
+            node = nodes[0]
+            for weightNode in node.getElementsByTagName('Weights'):
+                for child in weightNode.childNodes:
+                    if child.nodeType == child.ELEMENT_NODE and child.firstChild is not None:
+                        weights[child.nodeName] = float(child.firstChild.data.strip())
+            defineNodes = node.getElementsByTagName('Define')
+            if defineNodes:
+                defines = [(n.getAttribute('name'), n.firstChild.data) for n in defineNodes if n.firstChild is not None]
+            expressionNodes = node.getElementsByTagName('Expression')
+            if expressionNodes and expressionNodes[0].firstChild is not None and expressionNodes[0].firstChild.data.strip():
+                expression = expressionNodes[0].firstChild.data
+        self.m_scoring = sentinelLib.ScoringEngine(expression, weights, defines)
+        return self.m_scoring
+
+
+    def getClient(self, url):
+        client = getattr(self.m_stac_local, 'client', None)
+        if client is None:
+            client = Client.open(url)
+            self.m_stac_local.client = client
+        return client
 
 
+    def stacFields(self, client):
+        # STAC fields extension projection limited to what buildSceneBatch reads, None when the endpoint lacks support.
+        if self.m_fields_supported is None:
+            try:
+                self.m_fields_supported = client.conforms_to(ConformanceClasses.FIELDS)
+            except Exception:
+                self.m_fields_supported = False
+        if not self.m_fields_supported:
+            return None
+        return self.stacProjection()
+
+
+    def stacProjection(self):
+        # the projection requested when the endpoint supports it, also part of the cache key (a full item answers it too).
+        return {'include': sentinelLib.CSTAC_FIELDS, 'exclude': ['links']}
+
+
+    def searchPages(self, url, collections, aoi, dateTime, query, cache=None):
+        # runs on a pipeline fetch worker, yields one list of item dicts per STAC page so the next page is fetched while the
+        # previous one is converted and written. Pages are served from/stored to the on-disk cache when one is configured,
+        # the client is only opened on a miss or revalidation so fresh and closed windows never touch the network.
+        cacheKey = None
+        cacheEntry = None
+        if cache is not None:
+            cacheKey = cache.key(url, collections, aoi, dateTime, query, fields=self.stacProjection())
+            cacheEntry, fresh = cache.get(cacheKey)
+            if cacheEntry is not None and fresh:
+                for page in cacheEntry['pages']:
+                    yield page
+                return
+        client = self.getClient(url)
+        fields = self.stacFields(client)
+        searchArgs = dict(
+                            collections = collections,
+                            intersects = aoi,
+                            datetime = dateTime,
+                            query=query,
+                            sortby=[{'field': 'properties.datetime', 'direction': 'asc'}, {'field': 'id', 'direction': 'asc'}]   # keep MasterTiles reproducible.
+                        )
+        if fields is not None:
+            searchArgs['fields'] = fields
+        search = client.search(**searchArgs)
+        matched = None
+        if cacheEntry is not None:
+            matched = search.matched()
+            if matched is not None and matched == cacheEntry['meta']['matched']:    # revalidated, nothing new for this window.
+                cache.touch(cacheKey, cacheEntry)
+                for page in cacheEntry['pages']:
+                    yield page
+                return
+        pages = []
+        pageIter = search.pages_as_dicts()
+        try:
+            page = next(pageIter, None)
+        except Exception:
+            if fields is None:
+                raise
+            # endpoint advertised the fields extension but rejected the projection, fall back to full items.
+            self.m_fields_supported = False
+            del searchArgs['fields']
+            search = client.search(**searchArgs)
+            pageIter = search.pages_as_dicts()
+            page = next(pageIter, None)
+        while page is not None:
+            features = page['features']
+            if matched is None:
+                matched = page.get('numberMatched', page.get('context', {}).get('matched'))
+            pages.append(features)
+            yield features
+            page = next(pageIter, None)
+        if cache is not None:
+            cache.put(cacheKey, dateTime, pages, matched)
+
+
+    def countMatches(self, url, collections, aoi, dateTime, query):
+        # numberMatched for a window, None when the endpoint does not report it.
+        try:
+            client = self.getClient(url)
+            search = client.search(collections = collections, intersects = aoi, datetime = dateTime, query=query, limit=1)
+            return search.matched()
 
-            NumDate  = AcquisitionDate[0:4]+AcquisitionDate[5:7]+AcquisitionDate[8:10]
-            jsonValList.append(NumDate)
+        except Exception:
+            return None
 
-            min_X = str(jsData.bbox[0])
-            min_Y = str(jsData.bbox[1])
-            max_X = str(jsData.bbox[2])
-            max_Y = str(jsData.bbox[3])
-            Tile_BB_Values = min_X + ","+ min_Y + ","+ max_X + ","+ max_Y
-            jsonValList.append(Tile_BB_Values)
 
+    def createSession(self, workers):
+        # keep-alive connection pool shared by the fetch workers.
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, workers), max_retries=3)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
 
-            Shape = jsData.assets['visual'].extra_fields['proj:shape'][0]
-            min_X = jsData.assets['visual'].extra_fields['proj:transform'][2]
-            max_Y = jsData.assets['visual'].extra_fields['proj:transform'][5]
-            Multipliers = jsData.assets['visual'].extra_fields['proj:transform'][0]
 
-            max_X = min_X + Shape * Multipliers
-            min_Y = max_Y - Shape * Multipliers
+    def fetchItem(self, session, url, timeout, bucket=None):
+        if bucket is not None:
+            bucket.acquire()
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
 
 
-            RasterProxy_BB_Values = str(max_X) + ","+ str(max_Y) + ","+ str(min_X) + ","+ str(min_Y)
-            jsonValList.append(RasterProxy_BB_Values)
+    def writePipeline(self, data, pipeline, tasks, output, describeTask=None, sceneIndex=None, nameTask=None):
+        # returns the number of failed searches, fetches, conversions and rows, 0 when everything was written.
+        # nameTask(task) names a failed task in the log, by default the task itself (the item URL in CSV mode).
+        log = data['log']
+        failed = 0
+        for msg, task, rows in pipeline.run(tasks):
+            if msg == 'task':
+                if describeTask is not None:
+                    log.Message(describeTask(task),log.const_general_text)
+            elif msg == 'error':
+                if task is None:
+                    log.Message(str(rows),2)
+                else:
+                    name = task if nameTask is None else nameTask(task)
+                    log.Message(("Unable to read {} ({})...Moving to the next grid".format(name, rows)),2)
+                failed += 1
+            else:
+                batch = rows
+                for itemId, err in batch.errors:
+                    log.Message(("Unable to read {} ({})...Moving to the next grid".format(itemId, err)),2)
+                failed += len(batch.errors)
+                failed += self.writeBatch(data, pipeline, batch, output)
+        if sceneIndex is not None:
+            # reprocessings are resolved once every item has been seen, the newest one of each product is held back
+            # by the index until here (one item per product, not the whole run).
+            batch = sentinelLib.buildSceneBatch(sceneIndex.flush())
+            for itemId, err in batch.errors:
+                log.Message(("Unable to read {} ({})...Moving to the next grid".format(itemId, err)),2)
+            failed += len(batch.errors)
+            failed += self.writeBatch(data, pipeline, batch, output)
+            log.Message(("{} duplicate scene(s) dropped before insert".format(sceneIndex.m_dropped)),log.const_general_text)
+        for stageReport in pipeline.report():
+            log.Message(stageReport,log.const_general_text)
+        return failed
+
+
+    def sceneRow(self, data, row, store=None, resampling='nearest'):
+        # one BandTiles row per scene (scene layout): a 15 band VRT over the band COGs, added with Sentinel2_Scene.art.xml.
+        # With a store the bands go through their caching MRFs and the VRT itself is stored, otherwise it is inline and
+        # reads the COGs directly. resampling brings the 20m/60m bands to the 10m grid (<scene_resampling>).
+        srs = 'EPSG:' + str(row[7])
+        coordinate = row[10].split(",")
+        sources = {}
+        for band in sentinelLib.BANDS:
+            if store is not None:
+                sources[band] = store.put(self.embedMRF(data,row[5],coordinate[0],coordinate[1],coordinate[2],coordinate[3],srs,band))
+            else:
+                sources[band] = self.getSourceProfile(data).source(row[5] + band + '.tif')
+        vrt = sentinelLib.sceneVRT(sources, coordinate, row[7], resampling)
+        if store is not None:
+            vrt = store.put(vrt, '.vrt')
+        return [row[0], row[1], row[2], row[3], row[4], row[6], row[7], row[8], row[11], row[12], vrt, 'MS']
+
+
+    def writeBatch(self, data, pipeline, batch, output):
+        # output: {'master': MasterTiles BatchWriter or None, 'band': BandTiles BatchWriter,
+        #          'store': sentinelLib.DescriptorStore or None, 'layout': 'band' or 'scene', 'scenes': product URLs written}
+        # the band rows are expanded from the same in-memory row, MasterTiles is never read back. Returns the number of
+        # scenes that could not be expanded. Scenes without a valid footprint or score go to the reject file of
+        # MasterTiles (BandTiles without it) and are counted by closeWriters.
+        log = data['log']
+        t0 = time.time()
+        failed = 0
 
+        def reject(row, exp):
+            log.Message(("Unable to add scene {} ({})...Moving to the next scene".format(row[3], exp)),2)
+            (output['master'] if output['master'] is not None else output['band']).reject(row, exp)
 
-            Q = 42572
-            jsonValList.append(Q)
+        for JsonData in self.sceneRows(data, batch, reject):
+            try:
+                if output['master'] is not None:
+                    output['master'].add(JsonData)
+                output['scenes'].append(JsonData[5])
+                if output['layout'] == 'scene':
+                    output['band'].add(self.sceneRow(data, JsonData, output['store'], output['resampling']))
+                    continue
+                for datareq in self.bandRows(data, JsonData, output['store']):
+                    output['band'].add(datareq) #insert data to feature class
 
-            Best = 542572
-            jsonValList.append(Best)
+            except Exception as exp:
+                log.Message(str(exp),2)
+                failed += 1
+        pipeline.writeStats.add(len(batch), time.time() - t0)
+        return failed
 
 
+    def openWriter(self, data, featClass, fields, batchSize, rejectPath):
+        # BatchWriter over an InsertCursor opened inside an edit session on the feature class workspace, one edit
+        # operation per batch. close() flushes, releases the cursor and saves the edits.
+        log = data['log']
+        edit = arcpy.da.Editor(os.path.dirname(featClass))
+        edit.startEditing(False, False)
+        cursor = [arcpy.da.InsertCursor(featClass, fields)]
 
-            del AcquisitionDate,cloudcover,ProductName,ProductURL,srs,NumDate,Tile_BB_Values
-            del jsData,wgs_sr
+        def finish():
+            del cursor[:]
+            edit.stopEditing(True)
 
-            return jsonValList
+        def batchLog(name, rows, seconds, rejected):
+            log.Message(("{}: wrote {} row(s) in {:.2f}s, {} rejected".format(name, rows, seconds, rejected)),log.const_general_text)
 
-        except Exception as exp:
-            log.Message(str(exp),2)
-            log.Message(("Unable to create a valid json ...Moving to the next grid"),2)
-            return False
+        return sentinelLib.BatchWriter(os.path.basename(featClass), lambda row: cursor[0].insertRow(row), batchSize,
+                                       rejectPath, edit.startOperation, edit.stopOperation, edit.abortOperation,
+                                       finish, batchLog)
 
 
-    def date_range(self, data,start, end, intv):
+    def closeWriters(self, data, writers):
+        # returns the number of rejected rows, a writer that fails to close counts as one.
         log = data['log']
-        datelist =[]
-        try:
-            start = datetime.strptime(start,"%Y-%m-%d").date()
-            end = datetime.strptime(end,"%Y-%m-%d").date()
-            diff = (end-start)//int(intv)
-            for i in range(int(intv)):
-                startdate = ((start + diff * i).strftime("%Y-%m-%d"))
-                endDate = ((start + diff * (i+1)).strftime("%Y-%m-%d"))
-                datelist.append(startdate+'/'+endDate)
-            return datelist
-            
-        except Exception as exp:
-            log.Message(str(exp),2)
-            log.Message(("Unable to create a valid date range"),2)
-            return False
+        failed = 0
+        for writer in writers:
+            if writer is None:
+                continue
+            try:
+                writer.close()
+            except Exception as exp:
+                log.Message(str(exp),2)
+                failed += 1
+            log.Message(writer.report(),log.const_general_text)
+            if writer.m_rejected:
+                log.Message(("{} row(s) could not be written to {}, see {}".format(writer.m_rejected, writer.m_name, writer.m_reject_path)),2)
+            failed += writer.m_rejected
+        return failed
+
+
+    def convertPage(self, data, page, watermark=None, sceneIndex=None):
+        # runs on the pipeline converter thread, no arcpy here. Returns a sentinelLib.SceneBatch for the writer.
+        items = []
+        for item in page:
+            if watermark is not None:
+                if not watermark.isNew(item):
+                    continue
+                watermark.observe(item)
+            if sceneIndex is not None and not sceneIndex.accept(item):
+                continue
+            items.append(item)
+        return sentinelLib.buildSceneBatch(items)
+
+
+    def buildCogIndex(self, data, root, productUrls):
+        # fetches the header of every band COG of the new scenes once and stores the tile offsets/byte counts of all
+        # levels in a sentinelLib.CogIndex under root, so sentinelLib.TileReader can serve a tile with one range request.
+        log = data['log']
+        index = sentinelLib.CogIndex(root)
+        todo = [url for url in dict.fromkeys(productUrls) if not index.exists(url)]
+        if not todo:
+            return True
+        httpWorkers = int(self.getConfigValue(data, 'http_workers', 8))
+        fetchBand = sentinelLib.httpRangeFetcher(self.createSession(httpWorkers), float(self.getConfigValue(data, 'http_timeout', 30)))
+        log.Message(("Indexing the COG tiles of {} scene(s) using {} connection(s)...".format(len(todo), httpWorkers)),log.const_general_text)
+        t0 = time.time()
+
+        def build(url):
+            try:
+                return index.build(url, fetchBand), None
+            except Exception as exp:
+                return 0, exp
+
+        requestCount = 0
+        with ThreadPoolExecutor(max_workers=httpWorkers) as pool:
+            for url, (made, err) in zip(todo, pool.map(build, todo)):
+                requestCount += made
+                if err is not None:
+                    log.Message(("Unable to index {} ({})".format(url, err)),2)
+        log.Message(("COG index: {} scene(s), {} header request(s) in {:.1f}s".format(len(todo), requestCount, time.time() - t0)),log.const_general_text)
+        return True
 
 
     def sentinelModifySrc(self, data):
@@ -586,7 +764,59 @@ class UserCode:
             dateInterval = interval
 
 
-        
+        if CSV_path != "#" and not CSV_path.lower().endswith('.csv'):
+            log.Message(("File provided " + CSV_path + " is Incorrect. It should be CSV"),2)
+            log.Message(("Terminating the program"),2)
+            return False
+
+        # every setting is parsed before the feature classes are opened for editing, a bad value stops the run here.
+        try:
+            self.getScoringEngine(data)     # compiled once, invalid expressions stop the run here.
+            self.getMRFTemplate(data)       # as are unknown source profiles and cache layouts.
+            httpWorkers = int(self.getConfigValue(data, 'http_workers', 8))
+            httpTimeout = float(self.getConfigValue(data, 'http_timeout', 30))
+            httpRate = float(self.getConfigValue(data, 'http_rate', 0))
+            stacWorkers = int(self.getConfigValue(data, 'stac_workers', 4))
+            stacBudget = self.getConfigValue(data, 'stac_item_budget', None)
+            if stacBudget is not None:
+                stacBudget = int(stacBudget)
+            stacPrefetch = int(self.getConfigValue(data, 'stac_prefetch', 2))
+            stacCacheTTL = float(self.getConfigValue(data, 'stac_cache_ttl', 24))
+            aoiTiling = self.getConfigValue(data, 'aoi_tiling', '#')
+            aoiCells = sentinelLib.splitAOI(coordinateList, aoiTiling)
+            writeBatchSize = int(self.getConfigValue(data, 'write_batch', 1000))
+            sceneResampling = sentinelLib.checkSceneResampling(self.getConfigValue(data, 'scene_resampling', 'nearest').lower())
+        except Exception as exp:
+            log.Message(str(exp),2)
+            log.Message(("Terminating the program"),2)
+            return False
+
+        url = 'https://earth-search.aws.element84.com/v1'
+        collections='sentinel-2-l2a'
+        masterTilesPath = os.path.join(masterFc,'MasterFC.gdb','MasterTiles')
+        # MasterTiles (one row per scene) is an optional summary, BandTiles is built directly from the ingest pass.
+        writeMaster = self.getConfigValue(data, 'master_tiles', 'yes').lower() in ('yes', 'true', '1')
+
+        # incremental runs append to MasterTiles (when written) and narrow the search window to items newer than the persisted watermark.
+        watermark = None
+        appendMaster = False
+        resumeSearch = False
+        if self.getConfigValue(data, 'incremental', 'no').lower() in ('yes', 'true', '1'):
+            watermarkKey = sentinelLib.Watermark.key(url, collections, coordinateList, cloudePercentage)
+            watermark = sentinelLib.Watermark(os.path.join(paramPath, 'Watermark', watermarkKey + '.json'))
+            if watermark.load() and (not writeMaster or arcpy.Exists(masterTilesPath)):
+                appendMaster = writeMaster
+                resumeSearch = True
+                startDate = watermark.searchStart()
+                log.Message(("Incremental ingest, watermark " + watermark.m_datetime + ", searching from " + startDate + "..."),log.const_general_text)
+            else:
+                watermark.m_datetime = watermark.m_updated = None    # full rebuild, take in everything from startDate.
+        if endDate == "#":
+            endDate = datetime.utcnow().strftime("%Y-%m-%d")
+        if resumeSearch:
+            daysToSearch = (datetime.strptime(endDate,"%Y-%m-%d") - datetime.strptime(startDate,"%Y-%m-%d")).days
+            dateInterval = max(1, min(int(dateInterval), daysToSearch))
+
         datelist = self.date_range(data, startDate, endDate, dateInterval)
       
 
@@ -640,194 +870,774 @@ class UserCode:
 
 
         # Column for master feature class
-        field_list_Master_FC=['SHAPE@','AcquisitionDate','CloudCover','Name','ProductID','ProductURL','Constellation','SRS',"NumDate",'Tile_BB_Values','RasterProxy_BB_Values','Q','Best']
+        field_list_Master_FC=['SHAPE@','AcquisitionDate','CloudCover','Name','ProductID','ProductURL','Constellation','SRS',"NumDate",'Tile_BB_Values','RasterProxy_BB_Values','Q','Best','NoDataPct']
+        featureclassFullPath = None
         try :
+            if appendMaster:
+                featureclassFullPath = masterTilesPath
+                if len(arcpy.ListFields(masterTilesPath, 'NoDataPct')) == 0:     # MasterTiles created before NoDataPct existed.
+                    arcpy.AddField_management(masterTilesPath, 'NoDataPct', 'Float')
+            elif writeMaster:
+                arcpy.env.overwriteOutput=True
+                featureclassFullPath = self.createFeatureClass(data,masterFc,'MasterFC.gdb','MasterTiles')
+                self.addFieldsMasterFC(data,featureclassFullPath,field_list_Master_FC[0:])
+
+        except Exception as exp:
+            log.Message(str(exp),2)
+
+        # Column for band feature class, rebuilt every run with the scenes added by this run. The default layout has
+        # one row per band grouped into a scene by Sentinel2_MS.art.xml, <scene_layout>scene writes one multiband
+        # VRT row per scene instead (15x fewer rows, inline VRTs need a longer Raster field).
+        sceneLayout = self.getConfigValue(data, 'scene_layout', 'band').lower()
+        field_list=['SHAPE@','AcquisitionDate','CloudCover','ID','ProductID','Constellation','SRS',"NumDate",'Q','Best','Raster','Tag']
+        featureclass = None
+        try:
             arcpy.env.overwriteOutput=True
-            featureclassFullPath = self.createFeatureClass(data,masterFc,'MasterFC.gdb','MasterTiles')
-            self.addFieldsMasterFC(data,featureclassFullPath,field_list_Master_FC[0:])
+            featureclass = self.createFeatureClass(data,bandFc,"BandFC.gdb",'BandTiles')
+            self.addFields(data,featureclass,field_list[0:],10000 if sceneLayout == 'scene' else 5000)
 
         except Exception as exp:
             log.Message(str(exp),2)
 
 
-        cursor = arcpy.da.InsertCursor(featureclassFullPath,field_list_Master_FC)
 
-        if CSV_path != "#":
-            if CSV_path.lower().endswith('.csv'):
+        # duplicate STAC ids (shared interval boundary days, overlapping AOI cells, earlier runs) and optionally older
+        # reprocessings of the same product are dropped here instead of being added to the mosaic and removed later.
+        dedupeProduct = self.getConfigValue(data, 'dedupe_product', 'no').lower() in ('yes', 'true', '1')
+        sceneIndex = sentinelLib.SceneIndex(dedupeProduct)
+        if appendMaster:
+            with arcpy.da.SearchCursor(masterTilesPath, ['Name', 'ProductID', 'OID@']) as sc:
+                for row in sc:
+                    sceneIndex.addExisting(row[0], row[1], row[2])
+
+        # rows are buffered and written in batches, each batch one edit operation. Failed rows go to a reject file.
+        rejectPath = self.getConfigValue(data, 'reject_path', os.path.join(paramPath, 'Reject'))
+        runStamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        output = {'master': None, 'band': None, 'store': None, 'layout': sceneLayout, 'resampling': sceneResampling, 'scenes': []}
+        # optional sidecar store for the MRF descriptors, BandTiles.Raster then holds a short path instead of the XML.
+        mrfStore = self.getConfigValue(data, 'mrf_store', None)
+        if mrfStore is not None:
+            output['store'] = sentinelLib.DescriptorStore(mrfStore)
+        elif sceneLayout == 'scene':
+            # the inline scene VRTs can not reference caching MRFs, every read then goes to the source COGs.
+            log.Message(("<scene_layout>scene without <mrf_store>: the scene VRTs read the COGs directly, bypassing the MRF cache"),1)
+        # the edit sessions are always closed, also when a search or write stage raises, so the rows written so far
+        # are saved and the rejects reported.
+        failed = 0
+        try:
+            output['band'] = self.openWriter(data, featureclass, field_list, writeBatchSize,
+                                             os.path.join(rejectPath, 'BandTiles_' + runStamp + '.jsonl'))
+            if featureclassFullPath is not None:
+                output['master'] = self.openWriter(data, featureclassFullPath, field_list_Master_FC, writeBatchSize,
+                                                   os.path.join(rejectPath, 'MasterTiles_' + runStamp + '.jsonl'))
+            if CSV_path != "#":
                 path = CSV_path
                 try:
+                    urlList = []
                     with open(path) as csv_file:
                         csv_reader = csv.reader(csv_file, delimiter=',')
                         for row in csv_reader:
                             for url in row:
                                 if url.startswith("https") or url.startswith("http"):
                                     if url.endswith('.json'):
-                                        JsonData = self.readJson(data,url)
-                                        if JsonData != False:
-                                            try:
-                                                log.Message(("adding to the feature class " + JsonData[3] + "..."),log.const_general_text)
-                                                cursor.insertRow(JsonData)
-
-                                            except Exception as exp:
-                                                log.Message(str(exp),2)
-
+                                        urlList.append(url)
+
+                    log.Message(("Fetching {} item(s) using {} connection(s)...".format(len(urlList), httpWorkers)),log.const_general_text)
+                    session = self.createSession(httpWorkers)
+                    bucket = sentinelLib.TokenBucket(httpRate)
+                    # one pipeline task per URL, fetched over the pooled session and fed to the same row builder as STAC searches.
+                    # A generator, so the fetch runs inside the pipeline's timed next() and shows in the fetch stats.
+                    def itemPages(url):
+                        yield [self.fetchItem(session, url, httpTimeout, bucket)]
+
+                    pipeline = sentinelLib.IngestPipeline(
+                                        itemPages,
+                                        lambda page: self.convertPage(data, page, None, sceneIndex),
+                                        workers=httpWorkers,
+                                        prefetch=1
+                                    )
+                    failed = self.writePipeline(data, pipeline, urlList, output, None, sceneIndex)
 
                 except Exception as exp:
                     log.Message(str(exp),2)
+                    failed += 1
 
+            else:
+                query={'eo:cloud_cover': {'lt': float(cloudePercentage)}}
+                if stacBudget is not None:
+                    # adaptive windows, dense periods are bisected and sparse neighbours merged to keep each query near the budget.
+                    planStart = datetime.strptime(startDate,"%Y-%m-%d")
+                    planEnd = datetime.strptime(endDate,"%Y-%m-%d") + timedelta(days=1)
+                    aoiFull = sentinelLib.bboxPolygon(coordinateList)
+                    windows = sentinelLib.planWindows(planStart, planEnd, dateInterval,
+                                    lambda window: self.countMatches(url, collections, aoiFull, window, query),
+                                    stacBudget, stacWorkers)
+                    datelist = [window for window, count in windows]
+                    for window, count in windows:
+                        log.Message(("Planned window {} ({} items)".format(window, count)),log.const_general_text)
+                # optionally split the AOI into grid cells, each (interval, cell) pair becomes one concurrent sub-query.
+                searchTasks = []
+                for dateTime in datelist:
+                    for cell in aoiCells:
+                        aoi_as_dict: Dict[str, Any] = sentinelLib.bboxPolygon(cell)
+                        searchTasks.append((dateTime, aoi_as_dict))
+                if len(aoiCells) > 1:
+                    log.Message(("AOI split into {} cell(s) using {}".format(len(aoiCells), aoiTiling)),log.const_general_text)
+                stacCache = None
+                stacCachePath = self.getConfigValue(data, 'stac_cache', None)
+                if stacCachePath is not None:
+                    stacCache = sentinelLib.StacCache(stacCachePath, ttl=stacCacheTTL * 3600)
+                    log.Message(("Using STAC response cache " + stacCachePath + "..."),log.const_general_text)
+                log.Message(("Searching {} interval(s) x {} cell(s) using {} worker(s)...".format(len(datelist), len(aoiCells), stacWorkers)),log.const_general_text)
+                # fetch -> convert -> write stages connected by bounded queues. Sub-queries are fetched concurrently and drained in
+                # task order, so the single InsertCursor on this thread sees a deterministic sequence.
+                pipeline = sentinelLib.IngestPipeline(
+                                    lambda task: self.searchPages(url, collections, task[1], task[0], query, stacCache),
+                                    lambda page: self.convertPage(data, page, watermark, sceneIndex),
+                                    workers=stacWorkers,
+                                    prefetch=stacPrefetch
+                                )
+                failed = self.writePipeline(data, pipeline, searchTasks, output, lambda task: "adding to the feature class for interverl "+task[0]+"...", sceneIndex,
+                                            lambda task: "interval {} cell {}-{}".format(task[0], task[1]['coordinates'][0][0], task[1]['coordinates'][0][2]))
+        finally:
+            failed += self.closeWriters(data, [output['master'], output['band']])
+        try:
+            sentinelLib.SceneLedger(os.path.join(paramPath, 'Cache', 'scenes.txt')).add(output['scenes'])
+        except Exception as exp:
+            log.Message(str(exp),1)
+        # the mark only moves once every window was searched and every row written, otherwise the scenes of a failed
+        # window would fall behind the lookback and never be searched again.
+        if watermark is not None:
+            if failed:
+                log.Message(("Watermark kept at {}, {} search(es)/row(s) failed".format(watermark.m_datetime, failed)),1)
+            elif watermark.save(aoi=coordinateList, cloud=cloudePercentage):
+                log.Message(("Watermark advanced to " + watermark.m_new_datetime),log.const_general_text)
+        # MasterTiles rows of products this run took in a newer reprocessing of are replaced, i.e. removed once the new
+        # rows were written. Their mosaic items stay until the mosaic is rebuilt or they are removed.
+        if sceneIndex.m_superseded and output['master'] is not None:
+            if failed:
+                log.Message(("{} older reprocessing(s) kept in MasterTiles, {} search(es)/row(s) failed".format(len(sceneIndex.m_superseded), failed)),1)
+            else:
+                try:
+                    removed = 0
+                    oidField = arcpy.Describe(masterTilesPath).OIDFieldName
+                    for where in sentinelLib.inClauses(oidField, sceneIndex.m_superseded):
+                        with arcpy.da.UpdateCursor(masterTilesPath, ['OID@'], where) as uc:
+                            for row in uc:
+                                uc.deleteRow()
+                                removed += 1
+                    log.Message(("{} older reprocessing(s) replaced in MasterTiles".format(removed)),log.const_general_text)
+                except Exception as exp:
+                    log.Message(str(exp),1)
+        if output['store'] is not None:
+            log.Message(output['store'].report(),log.const_general_text)
+        cogIndexPath = self.getConfigValue(data, 'cog_index', None)
+        if cogIndexPath is not None:
+            self.buildCogIndex(data, cogIndexPath, output['scenes'])
+
+        # rows added by this run were scored during ingest, older MasterTiles rows are only rescored on request
+        # (<rescore>all after a formula change), so the scoring cost does not grow with the table.
+        if appendMaster and self.getConfigValue(data, 'rescore', 'new').lower() == 'all':
+            self.findBestTiles(data, masterTilesPath)
+
+        xmlDOM.getElementsByTagName("data_path")[0].firstChild.data = featureclass
+        if sceneLayout == 'scene':
+            xmlDOM.getElementsByTagName("raster_type")[0].firstChild.data = 'Sentinel2_Scene.art.xml'
+        arcpy.env.overwriteOutput = False
 
+        return True
 
-            else:
-                log.Message(("File provided " + CSV_path + " is Incorrect. It should be CSV"),2)
-                log.Message(("Terminating the program"),2)
-                return False
+    def rescoreMasterTiles(self, data):
+        # recomputes Q/Best of existing MasterTiles rows, all of them by default or those matching <rescore_where>
+        # (e.g. OBJECTID > 120000, or a date range).
+        log = data['log']
+        base = data['base']
+        masterFC = os.path.join(base.const_import_geometry_features_path_, 'MasterFC', 'MasterFC.gdb', 'MasterTiles')
+        if not arcpy.Exists(masterFC):
+            log.Message(("Unable to find " + masterFC),2)
+            return False
+        return self.findBestTiles(data, masterFC, self.getConfigValue(data, 'rescore_where', None))
 
+    def prewarmCache(self, data):
+        # run after AR: fills the MRF caches of the scenes in BandTiles (the scenes added by the last sentinelModifySrc)
+        # for <prewarm_bands> at the Rsets <prewarm_levels>, within <prewarm_budget_mb>. Progress is kept in
+        # Parameter/Prewarm/state.json, running the command again continues an interrupted or budget-limited run.
+        # Experimental, see sentinelLib.CachePrewarmer.
+        log = data['log']
+        base = data['base']
+        try:
+            log.Message(("prewarmCache is experimental, check the cache files it reports before relying on it"),1)
+            paramPath = base.const_import_geometry_features_path_
+            bandFC = os.path.join(paramPath, 'BandFC', 'BandFC.gdb', 'BandTiles')
+            if not arcpy.Exists(bandFC):
+                log.Message(("Unable to find " + bandFC),2)
+                return False
+            self.getSourceProfile(data)
+            prewarmPath = os.path.join(paramPath, 'Prewarm')
+            bands = [band.strip() for band in self.getConfigValue(data, 'prewarm_bands', 'B02,B03,B04,B08').split(',')]
+            levels = [int(level) for level in self.getConfigValue(data, 'prewarm_levels', '2,3').split(',')]
+            budget = float(self.getConfigValue(data, 'prewarm_budget_mb', 1024)) * 1048576
+            workers = int(self.getConfigValue(data, 'prewarm_workers', 8))
+            # inline descriptors are written out once so GDAL can open them, the cache files they name stay the same.
+            store = sentinelLib.DescriptorStore(os.path.join(prewarmPath, 'mrf'))
+            paths = []
+            with arcpy.da.SearchCursor(bandFC, ['Raster', 'Tag']) as sc:
+                for row in sc:
+                    raster, tag = row
+                    if tag == 'MS':      # scene layout, the VRT references the band descriptors
+                        vrt = raster
+                        if not raster.lstrip().startswith('<'):
+                            with open(raster, 'r') as f:
+                                vrt = f.read()
+                        for band, source in sentinelLib.vrtSources(vrt).items():
+                            if band in bands and source.endswith('.mrf'):
+                                paths.append(source)
+                    elif tag in bands:
+                        paths.append(store.put(raster) if raster.lstrip().startswith('<') else raster)
+            paths = list(dict.fromkeys(paths))
+            if not paths:
+                log.Message(("No cached band descriptors to prewarm (scene VRTs without <mrf_store> read the COGs directly and have no cache)"),log.const_general_text)
+                return True
+            prewarmer = sentinelLib.CachePrewarmer(os.path.join(prewarmPath, 'state.json'), budget, workers, levels)
+            log.Message(("Prewarming {} descriptor(s), bands {} levels {} using {} worker(s)...".format(
+                len(paths), ','.join(bands), ','.join(str(level) for level in levels), workers)),log.const_general_text)
+            warmed, skipped, failed = prewarmer.run(paths, lambda message: log.Message(message,log.const_general_text))
+            log.Message(prewarmer.report(),log.const_general_text)
+            log.Message(("{} warmed, {} already warm, {} failed, {} left for the next run".format(
+                warmed, skipped, failed, len(paths) - warmed - skipped - failed)),log.const_general_text)
 
-        else:
-            url = 'https://earth-search.aws.element84.com/v1'
-            client = Client.open(url)
-            collections='sentinel-2-l2a'
-            query={'eo:cloud_cover': {'lt': float(cloudePercentage)}}
-            aoi_as_dict: Dict[str, Any] = {
-                        "type": "Polygon",
-                        "coordinates": [[
-                            [coordinateList[0], coordinateList[1]],
-                            [coordinateList[2], coordinateList[1]],
-                            [coordinateList[2], coordinateList[3]],
-                            [coordinateList[0], coordinateList[3]],
-                            [coordinateList[0], coordinateList[1]]
-                        ]]
-                    }
-            for dateTime in datelist:
-                try:
-                    search = client.search(
-                                        collections = collections,
-                                        intersects = aoi_as_dict,
-                                        datetime = dateTime,
-                                        query=query
-                                    )
+        except Exception as exp:
+            log.Message(str(exp),2)
+            return False
 
-                except Exception as exp:
-                    log.Message(str(exp),2)
-                try:
-                    log.Message(("adding to the feature class for interverl "+dateTime+"..."),log.const_general_text)
-                    for item in search.items():
-                        JsonData = self.readStac(data,item)
-                        if JsonData != False:
-                            try:
-                                log.Message(("adding to the feature class " + JsonData[3] + "..."),log.const_general_text)
-                                cursor.insertRow(JsonData)
-
-                            except Exception as exp:
-                                log.Message(str(exp),2)
-                except Exception as exp:
-                        log.Message(str(exp),2)
-        del cursor
+        return True
 
-        field_list=['SHAPE@','AcquisitionDate','CloudCover','ID','ProductID','Constellation','SRS',"NumDate",'Q','Best','Raster','Tag']
+    def cacheMaintenance(self, data):
+        # periodic maintenance of the <mrf_cache_root> folders: rescans the cache files, reports usage per band and the
+        # largest scenes, and evicts by <cache_policy> (lru/lfu) down to <cache_budget_gb>, sparing files accessed within
+        # <cache_grace_hours>. The budget is shared between the roots by weight, every root keeps its index (with the
+        # access counts) in Parameter/Cache/.
+        log = data['log']
+        base = data['base']
         try:
-            arcpy.env.overwriteOutput=True
-            featureclass = self.createFeatureClass(data,bandFc,"BandFC.gdb",'BandTiles')
-            self.addFields(data,featureclass,field_list[0:])
+            roots = self.getMRFTemplate(data).m_roots
+            totalWeight = sum(weight for root, weight in roots)
+            for cacheRoot, weight in roots:
+                cacheRoot = os.path.normpath(cacheRoot)
+                if not self.maintainCacheRoot(data, cacheRoot, weight / totalWeight):
+                    return False
+
+        except Exception as exp:
+            log.Message(str(exp),2)
+            return False
+
+        return True
 
+    def maintainCacheRoot(self, data, cacheRoot, share):
+        log = data['log']
+        base = data['base']
+        try:
+            budget = float(self.getConfigValue(data, 'cache_budget_gb', 500)) * 1073741824 * share
+            policy = self.getConfigValue(data, 'cache_policy', 'lru')
+            grace = float(self.getConfigValue(data, 'cache_grace_hours', 24)) * 3600
+            indexName = 'index.json' if share == 1 else 'index_' + sentinelLib.Watermark.key(cacheRoot) + '.json'
+            manager = sentinelLib.CacheManager(cacheRoot, os.path.join(base.const_import_geometry_features_path_, 'Cache', indexName),
+                                               budget, policy, grace)
+            if not manager.tracksAccess():
+                log.Message(("Reads do not update access times under {} (noatime mount or NTFS last access updates disabled), "
+                             "{} eviction only sees when tiles were last written. Enable atime on the volume (relatime is enough, "
+                             "fsutil behavior set disablelastaccess 0 on Windows)".format(cacheRoot, policy)),1)
+            files = manager.scan()
+            total = manager.total()
+            log.Message(("MRF cache {}: {} file(s), {:.2f} GB of {:.2f} GB".format(cacheRoot, len(files), total / 1073741824.0, budget / 1073741824.0)),log.const_general_text)
+            usage = manager.usage()
+            for band in sorted(usage['band']):
+                log.Message(("  {}: {:.2f} GB".format(band, usage['band'][band] / 1073741824.0)),log.const_general_text)
+            for scene in sorted(usage['scene'], key=usage['scene'].get, reverse=True)[:10]:
+                log.Message(("  {}: {:.1f} MB".format(scene, usage['scene'][scene] / 1048576.0)),log.const_general_text)
+            if total > budget:
+                evicted, freed, over = manager.enforce()
+                log.Message(("Evicted {} file(s) ({:.2f} GB) by {}".format(evicted, freed / 1073741824.0, policy)),log.const_general_text)
+                if over:
+                    log.Message(("Cache still {:.2f} GB over budget, the remaining files were used within the grace window or are in use".format(over / 1073741824.0)),2)
+            manager.save()
 
         except Exception as exp:
             log.Message(str(exp),2)
+            return False
 
+        return True
 
+    def cacheTelemetry(self, data):
+        # read-only report of the MRF caches under <mrf_cache_root>: cache files are matched to their scenes through the
+        # cache paths of every scene ingested (Parameter/Cache/scenes.txt, kept by sentinelModifySrc, and MasterTiles
+        # ProductURL for scenes ingested before it existed) under the current layout, and through the descriptor
+        # <DataFile> of the BandTiles rows for caches not yet migrated. They are summed per band, per scene and per time
+        # since last access, with the pages cached (counted from the MRF index where the cache has a separate one,
+        # estimated from the file size otherwise) and the estimated share of each raster cached. Written to
+        # <cache_metrics_json> and, for the node_exporter textfile collector, <cache_metrics_prom> (both default to
+        # Parameter/Cache/).
+        log = data['log']
+        base = data['base']
         try:
-            wrkSpace = os.path.join(masterFc,"MasterFC.gdb")
-            masterFC = os.path.join(wrkSpace,"MasterTiles")
-            field_list_master=['SHAPE@','AcquisitionDate','CloudCover','Name','ProductID','ProductURL','Constellation','SRS',"NumDate",'Tile_BB_Values','RasterProxy_BB_Values','Q','Best']
+            paramPath = base.const_import_geometry_features_path_
+            cachePath = os.path.join(paramPath, 'Cache')
+            pageRatio = float(self.getConfigValue(data, 'cache_page_ratio', 0.5))
+            mapping = {}
+            template = self.getMRFTemplate(data)
+            urls = sentinelLib.SceneLedger(os.path.join(cachePath, 'scenes.txt')).urls()
+            masterFC = os.path.join(paramPath, 'MasterFC', 'MasterFC.gdb', 'MasterTiles')
+            if arcpy.Exists(masterFC):
+                with arcpy.da.SearchCursor(masterFC, ['ProductURL']) as sc:
+                    urls.extend(row[0] for row in sc if row[0])
+            for url in dict.fromkeys(urls):
+                folder = template.cacheDir(url)
+                for band in sentinelLib.BANDS:
+                    mapping[os.path.normpath(folder + band + '.mrf_cache')] = (sentinelLib.sceneName(url), band)
+            bandFC = os.path.join(paramPath, 'BandFC', 'BandFC.gdb', 'BandTiles')
+            if arcpy.Exists(bandFC):
+
+                def addDescriptor(text, scene, band):
+                    dataFile = sentinelLib.mrfDataFile(text)
+                    if dataFile:
+                        mapping.setdefault(os.path.normpath(dataFile), (scene, band))
+
+                with arcpy.da.SearchCursor(bandFC, ['Raster', 'Tag', 'ID']) as sc:
+                    for raster, tag, scene in sc:
+                        text = raster
+                        if not raster.lstrip().startswith('<'):
+                            if not os.path.exists(raster):
+                                continue
+                            with open(raster, 'r') as f:
+                                text = f.read()
+                        if tag == 'MS':
+                            for band, source in sentinelLib.vrtSources(text).items():
+                                if source.endswith('.mrf') and os.path.exists(source):
+                                    with open(source, 'r') as f:
+                                        addDescriptor(f.read(), scene, band)
+                        else:
+                            addDescriptor(text, scene, tag)
+
+            roots = template.m_roots
+            files = {}
+            for cacheRoot, weight in roots:
+                cacheRoot = os.path.normpath(cacheRoot)
+                indexName = 'index.json' if len(roots) == 1 else 'index_' + sentinelLib.Watermark.key(cacheRoot) + '.json'
+                manager = sentinelLib.CacheManager(cacheRoot, os.path.join(cachePath, indexName), 0)
+                for key, entry in manager.scan().items():
+                    files[os.path.normpath(os.path.join(cacheRoot, key))] = entry
+            report = sentinelLib.cacheTelemetry(files, mapping, pageRatio)
+            report['unmapped'] = len([path for path in files if path not in mapping])
+            if report['unmapped']:
+                log.Message(("{} cache file(s) belong to no known scene and are reported by their folder names".format(report['unmapped'])),1)
+
+            jsonPath = self.getConfigValue(data, 'cache_metrics_json', os.path.join(cachePath, 'telemetry.json'))
+            promPath = self.getConfigValue(data, 'cache_metrics_prom', os.path.join(cachePath, 'mrf_cache.prom'))
+            sentinelLib.writeAtomic(jsonPath, json.dumps(report, indent=1))
+            sentinelLib.writeAtomic(promPath, sentinelLib.prometheusText(report))
+            log.Message(("MRF cache: {} file(s), {:.2f} GB, {} not matched to BandTiles".format(report['files'], report['bytes'] / 1073741824.0, report['unmapped'])),log.const_general_text)
+            for band in sorted(report['band']):
+                stats = report['band'][band]
+                log.Message(("  {}: {:.2f} GB, {} page(s) indexed + {} estimated, ~{:.1f}% cached (estimate)".format(
+                    band, stats['bytes'] / 1073741824.0, stats['pagesIndexed'], stats['pagesEstimated'], stats['cachedPctEstimated'])),log.const_general_text)
+            log.Message(("Telemetry written to " + jsonPath + " and " + promPath),log.const_general_text)
 
-            #cache_loc = r"Z:/mrfcache/cachingmrf/"
-            cache_loc = r"C:/mrfcache/cachingmrf/"
+        except Exception as exp:
+            log.Message(str(exp),2)
+            return False
 
-            try:
-                self.findBestTiles(data, masterFC)
+        return True
 
-            except Exception as exp:
-                log.Message(str(exp),3)
+    def migrateCacheLayout(self, data):
+        # moves existing caches to the configured <mrf_cache_root>/<mrf_cache_layout> and rewrites the descriptors that
+        # point at them, switching their sources to the <source_profile> on the way: the stored descriptor files
+        # (<mrf_store>, Parameter/Prewarm/mrf) in place, which migrates every catalog item that references them, and the
+        # inline descriptors in BandTiles, whose catalog items are then rebuilt from BandTiles by synchronizing the
+        # mosaic dataset. Items added from earlier BandTiles keep their old, still valid, cache paths and sources.
+        log = data['log']
+        base = data['base']
+        try:
+            template = self.getMRFTemplate(data)
+            paramPath = base.const_import_geometry_features_path_
+            moveCache = self.getConfigValue(data, 'migrate_move_cache', 'yes').lower() in ('yes', 'true', '1')
+            counts = {'descriptors': 0, 'moved': 0}
+
+            def migrate(text):
+                newText, oldCache, newCache = template.rewrite(text)
+                if newText is not text:
+                    counts['descriptors'] += 1
+                    if moveCache and sentinelLib.moveCacheFile(oldCache, newCache):
+                        counts['moved'] += 1
+                return newText
+
+            storeRoots = [os.path.join(paramPath, 'Prewarm', 'mrf')]
+            if self.getConfigValue(data, 'mrf_store', None) is not None:
+                storeRoots.append(self.getConfigValue(data, 'mrf_store', None))
+            for storeRoot in storeRoots:
+                for folder, dirs, names in os.walk(storeRoot):
+                    for name in names:
+                        if not name.endswith('.mrf'):
+                            continue
+                        path = os.path.join(folder, name)
+                        with open(path, 'r') as f:
+                            text = f.read()
+                        newText = migrate(text)
+                        if newText is not text:
+                            # in place, see sentinelLib.DescriptorStore on what that means for later put() calls.
+                            sentinelLib.writeAtomic(path, newText)
+            log.Message(("{} stored descriptor(s) rewritten, {} cache file(s) moved".format(counts['descriptors'], counts['moved'])),log.const_general_text)
+
+            bandFC = os.path.join(paramPath, 'BandFC', 'BandFC.gdb', 'BandTiles')
+            inline = 0
+            if arcpy.Exists(bandFC):
+                with arcpy.da.UpdateCursor(bandFC, ['Raster'], "Raster LIKE '<MRF_META>%'") as uc:
+                    for row in uc:
+                        newText = migrate(row[0])
+                        if newText is not row[0]:
+                            uc.updateRow([newText])
+                            inline += 1
+            log.Message(("{} inline BandTiles descriptor(s) rewritten".format(inline)),log.const_general_text)
+
+            ds = os.path.join(data['workspace'], data['mosaicdataset'])
+            if inline and arcpy.Exists(ds):
+                log.Message(("Rebuilding the catalog items of " + ds + " from BandTiles..."),log.const_general_text)
+                arcpy.SynchronizeMosaicDataset_management(ds, new_items='NO_NEW_ITEMS', sync_only_stale='SYNC_ALL',
+                                                          rebuild_raster='REBUILD_RASTER', existing_items='UPDATE_EXISTING_ITEMS',
+                                                          broken_items='IGNORE_BROKEN_ITEMS')
 
+        except Exception as exp:
+            log.Message(str(exp),2)
+            return False
 
-            try:
-                cursor = arcpy.da.InsertCursor(featureclass,field_list)
-                sc = arcpy.da.SearchCursor(masterFC,field_list_master)
-                log.Message(("adding band feature class ..."),log.const_general_text)
-                for row in sc:
-                    JsonData = []
+        return True
 
-                    try:
-                        JsonData.append(row[0])
-                        JsonData.append(row[1])
-                        JsonData.append(row[2])
-                        JsonData.append(row[3])
-                        JsonData.append(row[4])
-                        JsonData.append(row[6])
-                        JsonData.append(row[7])
-                        JsonData.append(row[8])
-                        JsonData.append(row[11])
-                        JsonData.append(row[12])
+    def markduplicate(self,data):
+        # marks every item but the best ranked one of each Name (lowest Best, then CloudCover, then OBJECTID) with
+        # Dataset_ID 'dup'. Only the names of the items added by the last AR (OBJECTID > m_last_AT_ObjectID) are ranked,
+        # so earlier items are touched only when a new item collides with them, and only the losing OIDs are written.
+        log = data['log']
+        base = data['base']
+        workspace = data['workspace']
+        md = data['mosaicdataset']
+        try:
+            ds = os.path.join(workspace, md)
+            oidField = arcpy.Describe(ds).OIDFieldName
+            arr = arcpy.da.FeatureClassToNumPyArray(ds, ['OID@','Name','Best','CloudCover'],
+                                                    null_value={'Name': '', 'Best': 2147483647, 'CloudCover': 100})
+            if len(arr) == 0:
+                return True
+            losers, names = sentinelLib.duplicateLosers(arr['OID@'], arr['Name'], arr['Best'], arr['CloudCover'],
+                                                        base.m_last_AT_ObjectID)
+            marked = 0
+            for where in sentinelLib.inClauses(oidField, losers):
+                with arcpy.da.UpdateCursor(ds, ['Dataset_ID'], where + " AND (Dataset_ID IS NULL OR Dataset_ID <> 'dup')") as rows:
+                    for row in rows:
+                        row[0] = 'dup'
+                        rows.updateRow(row)
+                        marked += 1
+            log.Message(("{} name(s) ranked, {} duplicate(s), {} newly marked".format(names, len(losers), marked)),log.const_general_text)
 
-                        srs = 'EPSG:' + str(JsonData[6])
+        except Exception as exp:
+            log.Message(str(exp),2)
+            return False
+
+        return True
 
+    def stacFieldsBenchmark(self, data):
+        # records one search (startDate/endDate/coordinate/cloud) with and without the fields projection under
+        # Parameter/Benchmark and compares bytes transferred and parse/convert time. Existing recordings are reused.
+        log = data['log']
+        base = data['base']
+        try:
+            url = 'https://earth-search.aws.element84.com/v1'
+            coordinateList = [float(v) for v in self.getConfigValue(data, 'coordinate', '-110,39.5,-105,40.5').split(',')]
+            body = {
+                'collections': ['sentinel-2-l2a'],
+                'intersects': sentinelLib.bboxPolygon(coordinateList),
+                'datetime': self.getConfigValue(data, 'startDate', '') + 'T00:00:00Z/' + self.getConfigValue(data, 'endDate', '') + 'T23:59:59Z',
+                'query': {'eo:cloud_cover': {'lt': float(self.getConfigValue(data, 'cloud', 20))}},
+                'limit': 100
+            }
+            recordPath = os.path.join(base.const_import_geometry_features_path_, 'Benchmark', sentinelLib.Watermark.key(body))
+            recordings = {}
+            for name, fields in (('full', None), ('fields', {'include': sentinelLib.CSTAC_FIELDS, 'exclude': ['links']})):
+                texts = []
+                index = 0
+                while os.path.exists(os.path.join(recordPath, '{}_{:03d}.json'.format(name, index))):
+                    with open(os.path.join(recordPath, '{}_{:03d}.json'.format(name, index)), 'r') as f:
+                        texts.append(f.read())
+                    index += 1
+                if not texts:
+                    log.Message(("Recording '{}' search responses to {}...".format(name, recordPath)),log.const_general_text)
+                    os.makedirs(recordPath, exist_ok=True)
+                    request = dict(body)
+                    if fields is not None:
+                        request['fields'] = fields
+                    while request is not None:
+                        response = requests.post(url + '/search', json=request, timeout=60)
+                        response.raise_for_status()
+                        texts.append(response.text)
+                        with open(os.path.join(recordPath, '{}_{:03d}.json'.format(name, len(texts) - 1)), 'w') as f:
+                            f.write(response.text)
+                        request = None
+                        for link in response.json().get('links', []):
+                            if link.get('rel') == 'next' and 'body' in link:
+                                request = dict(body, **link['body']) if link.get('merge') else link['body']
+                recordings[name] = texts
+            results = sentinelBench.benchmarkPayloads(recordings)
+            for name in ('full', 'fields'):
+                r = results[name]
+                log.Message(("{}: {} pages, {} items, {:.1f} KB, parse {:.1f} ms, convert {:.1f} ms".format(
+                    name, r['pages'], r['items'], r['bytes'] / 1024.0, r['parse_s'] * 1000, r['convert_s'] * 1000)),log.const_general_text)
+            if results['full']['bytes']:
+                log.Message(("fields projection: {:.1f}% of the bytes, {:.1f}% of the parse time".format(
+                    100.0 * results['fields']['bytes'] / results['full']['bytes'],
+                    100.0 * results['fields']['parse_s'] / max(results['full']['parse_s'], 1e-9))),log.const_general_text)
 
-                        datacoordinate = row[10]
-                        coordinate = datacoordinate.split(",")
+        except Exception as exp:
+            log.Message(str(exp),2)
+            return False
 
+        return True
 
 
+    def benchmarkBandRows(self, data, rowCount, store=None):
+        # synthetic BandTiles rows for the benchmark commands, one scene per 15 rows.
+        features = arcpy.Polygon(arcpy.Array([arcpy.Point(x, y) for x, y in
+                                 [(-105.0, 39.6), (-103.7, 39.6), (-103.7, 40.6), (-105.0, 40.6), (-105.0, 39.6)]]),
+                                 arcpy.SpatialReference(4326))
+        count = 0
+        scene = 0
+        while count < rowCount:
+            name = 'S2B_13SDA_20230701_{}_L2A'.format(scene)
+            productUrl = 'https://sentinel-cogs.s3.us-west-2.amazonaws.com/sentinel-s2-l2a-cogs/13/S/DA/2023/7/' + name + '/'
+            masterRow = [features, '2023-07-01 17:49:09', 10.0, name, name, productUrl, 'sentinel-2b', 32613, '20230701',
+                         None, '409800.0,4400040.0,300000.0,4290240.0', 54911, 54911]
+            for row in self.bandRows(data, masterRow, store)[:rowCount - count]:
+                yield row
+                count += 1
+            scene += 1
+
+
+    def bandWriterBenchmark(self, data):
+        # loads benchmark_rows (default 150000) synthetic BandTiles rows into scratch feature classes under
+        # Parameter/Benchmark, once with a plain per-row InsertCursor and once through the batched writer.
+        log = data['log']
+        base = data['base']
+        try:
+            benchPath = os.path.join(base.const_import_geometry_features_path_, 'Benchmark')
+            os.makedirs(benchPath, exist_ok=True)
+            rowCount = int(self.getConfigValue(data, 'benchmark_rows', 150000))
+            batchSize = int(self.getConfigValue(data, 'write_batch', 1000))
+            field_list=['SHAPE@','AcquisitionDate','CloudCover','ID','ProductID','Constellation','SRS',"NumDate",'Q','Best','Raster','Tag']
+
+            def rows():
+                return self.benchmarkBandRows(data, rowCount)
+
+            arcpy.env.overwriteOutput = True
+            results = []
+            for name in ('RowWise', 'Batched'):
+                featClass = self.createFeatureClass(data, benchPath, 'Writer.gdb', 'BandTiles_' + name)
+                self.addFields(data, featClass, field_list[0:])
+                t0 = time.time()
+                if name == 'RowWise':
+                    cursor = arcpy.da.InsertCursor(featClass, field_list)
+                    for row in rows():
                         try:
-                            bands = ["B01","B02","B03","B04","B05","B06","B07","B08","B8A","B09","B11","B12","SCL","WVP","AOT"]
-                            for band in bands:
-                                datareq = JsonData[:]
+                            cursor.insertRow(row)
+                        except Exception as exp:
+                            log.Message(str(exp),2)
+                    del cursor
+                else:
+                    writer = self.openWriter(data, featClass, field_list, batchSize,
+                                             os.path.join(benchPath, 'Writer_rejects.jsonl'))
+                    for row in rows():
+                        writer.add(row)
+                    writer.close()
+                elapsed = time.time() - t0
+                results.append((name, elapsed))
+                log.Message(("{}: {} rows in {:.1f}s, {:.0f} rows/s".format(name, rowCount, elapsed, rowCount / max(elapsed, 1e-9))),log.const_general_text)
+            arcpy.env.overwriteOutput = False
+            log.Message(("batched writer ({} rows/batch) took {:.1f}% of the per-row time".format(
+                batchSize, 100.0 * results[1][1] / max(results[0][1], 1e-9))),log.const_general_text)
 
-                                cachingmrf= self.embedMRF(data,cache_loc,row[5],coordinate[0],coordinate[1],coordinate[2],coordinate[3],srs,band)
-                                datareq.append(cachingmrf)
-                                datareq.append(band) #add to tag field.
+        except Exception as exp:
+            log.Message(str(exp),2)
+            return False
 
-                                cursor.insertRow(datareq) #insert data to feature class
+        return True
 
 
+    def scoringBenchmark(self, data):
+        # times the configured <Scoring> expression over benchmark_rows (default 1000000) synthetic scenes.
+        log = data['log']
+        try:
+            rowCount = int(self.getConfigValue(data, 'benchmark_rows', 1000000))
+            scoring = self.getScoringEngine(data)
+            seconds, matches = sentinelBench.benchmarkScoring(scoring, rowCount)
+            log.Message(("Scoring {} rows: {:.1f} ms ({:.1f}M rows/s)".format(rowCount, seconds * 1000, rowCount / max(seconds, 1e-9) / 1e6)),log.const_general_text)
+            if scoring.m_expression == sentinelLib.CSCORE_EXPRESSION:
+                log.Message(("default expression matches the reference scoring: {}".format(matches)),log.const_general_text)
 
-                        except Exception as exp:
-                            log.Message(str(exp),2)
+        except Exception as exp:
+            log.Message(str(exp),2)
+            return False
 
-                    except Exception as exp:
-                            log.Message(str(exp),2)
-                
-                del cursor
-                xmlDOM.getElementsByTagName("data_path")[0].firstChild.data = featureclass
-                arcpy.env.overwriteOutput = False
+        return True
 
-            except Exception as exp:
-                log.Message(str(exp),2)
+
+    def descriptorStoreBenchmark(self, data):
+        # loads benchmark_rows (default 150000) synthetic BandTiles rows twice, with the MRF descriptors inline and
+        # through a DescriptorStore, then compares geodatabase size and the time of a full SearchCursor scan.
+        log = data['log']
+        base = data['base']
+        try:
+            benchPath = os.path.join(base.const_import_geometry_features_path_, 'Benchmark')
+            os.makedirs(benchPath, exist_ok=True)
+            rowCount = int(self.getConfigValue(data, 'benchmark_rows', 150000))
+            field_list=['SHAPE@','AcquisitionDate','CloudCover','ID','ProductID','Constellation','SRS',"NumDate",'Q','Best','Raster','Tag']
+            arcpy.env.overwriteOutput = True
+            results = {}
+            for name in ('Inline', 'Store'):
+                store = sentinelLib.DescriptorStore(os.path.join(benchPath, 'MrfStore')) if name == 'Store' else None
+                featClass = self.createFeatureClass(data, benchPath, name + '.gdb', 'BandTiles')
+                self.addFields(data, featClass, field_list[0:])
+                with arcpy.da.InsertCursor(featClass, field_list) as cursor:
+                    for row in self.benchmarkBandRows(data, rowCount, store):
+                        cursor.insertRow(row)
+                arcpy.Compact_management(os.path.dirname(featClass))
+                t0 = time.time()
+                with arcpy.da.SearchCursor(featClass, field_list) as sc:
+                    for row in sc:
+                        pass
+                scan = time.time() - t0
+                size = sentinelLib.folderSize(os.path.dirname(featClass))
+                results[name] = (size, scan)
+                log.Message(("{}: geodatabase {:.1f} MB, full scan {:.2f}s".format(name, size / 1048576.0, scan)),log.const_general_text)
+                if store is not None:
+                    log.Message(store.report(),log.const_general_text)
+            arcpy.env.overwriteOutput = False
+            log.Message(("descriptor store: {:.1f}% of the geodatabase size, {:.1f}% of the scan time".format(
+                100.0 * results['Store'][0] / max(results['Inline'][0], 1), 100.0 * results['Store'][1] / max(results['Inline'][1], 1e-9))),log.const_general_text)
 
         except Exception as exp:
             log.Message(str(exp),2)
+            return False
 
         return True
 
-    def markduplicate(self,data):
+
+    def layoutBenchmark(self, data):
+        # builds the band layout (15 rows per scene, Sentinel2_MS.art.xml) and the scene layout (one VRT row per scene,
+        # Sentinel2_Scene.art.xml) from the existing MasterTiles in Parameter/Benchmark/Layout.gdb, adds each to its own
+        # mosaic dataset and times AR, BF and a catalog query at the centre of <coordinate>.
         log = data['log']
-        workspace = data['workspace']
-        md = data['mosaicdataset']
+        base = data['base']
         try:
-            ds = os.path.join(workspace, md)
-            with arcpy.da.UpdateCursor(ds,["Name","Dataset_ID"],sql_clause=(None, 'ORDER BY Name')) as rows: #Descending order on DataType_Format will ensure that cloned tiles are at the top and are not marked as duplicate
-                value1 = 'gp'
-                for row in rows:
-                    try:
-                        value = str(row[0])
-                        if value == value1:
-                            row[1] = 'dup'
-                            rows.updateRow(row)
+            paramPath = base.const_import_geometry_features_path_
+            masterFC = os.path.join(paramPath, 'MasterFC', 'MasterFC.gdb', 'MasterTiles')
+            if not arcpy.Exists(masterFC):
+                log.Message(("Unable to find " + masterFC),2)
+                return False
+            benchPath = os.path.join(paramPath, 'Benchmark')
+            os.makedirs(benchPath, exist_ok=True)
+            mrfStore = self.getConfigValue(data, 'mrf_store', None)
+            store = sentinelLib.DescriptorStore(mrfStore) if mrfStore is not None else None
+            coordinateList = [float(v) for v in self.getConfigValue(data, 'coordinate', '-110,39.5,-105,40.5').split(',')]
+            center = arcpy.PointGeometry(arcpy.Point((coordinateList[0] + coordinateList[2]) / 2, (coordinateList[1] + coordinateList[3]) / 2),
+                                         arcpy.SpatialReference(4326))
+            field_list_master=['SHAPE@','AcquisitionDate','CloudCover','Name','ProductID','ProductURL','Constellation','SRS',"NumDate",'Tile_BB_Values','RasterProxy_BB_Values','Q','Best']
+            field_list=['SHAPE@','AcquisitionDate','CloudCover','ID','ProductID','Constellation','SRS',"NumDate",'Q','Best','Raster','Tag']
+            with arcpy.da.SearchCursor(masterFC, field_list_master) as sc:
+                masterRows = [list(row) for row in sc]
+            arcpy.env.overwriteOutput = True
+            for layout, art in (('band', 'Sentinel2_MS.art.xml'), ('scene', 'Sentinel2_Scene.art.xml')):
+                featClass = self.createFeatureClass(data, benchPath, 'Layout.gdb', 'BandTiles_' + layout)
+                self.addFields(data, featClass, field_list[0:], 10000 if layout == 'scene' else 5000)
+                with arcpy.da.InsertCursor(featClass, field_list) as cursor:
+                    for row in masterRows:
+                        if layout == 'scene':
+                            cursor.insertRow(self.sceneRow(data, row, store))
                         else:
-                            value1 = value
+                            for datareq in self.bandRows(data, row, store):
+                                cursor.insertRow(datareq)
+                mdName = 'MD_' + layout
+                arcpy.CreateMosaicDataset_management(os.path.dirname(featClass), mdName, arcpy.SpatialReference(3857), 15, '16_BIT_UNSIGNED')
+                md = os.path.join(os.path.dirname(featClass), mdName)
+                timings = []
+                t0 = time.time()
+                arcpy.AddRastersToMosaicDataset_management(md, os.path.join(base.const_raster_type_path_, art), featClass,
+                                                           'NO_CELL_SIZES', 'NO_BOUNDARY')
+                timings.append(('AR', time.time() - t0))
+                t0 = time.time()
+                arcpy.BuildFootprints_management(md, reset_footprint='NONE', approx_num_vertices=30, shrink_distance=300,
+                                                 update_boundary='NO_BOUNDARY')     # the DEA.xml BF settings
+                timings.append(('BF', time.time() - t0))
+                t0 = time.time()
+                layer = arcpy.MakeMosaicLayer_management(md, mdName + '_lyr')
+                arcpy.SelectLayerByLocation_management(layer, 'INTERSECT', center)
+                hits = int(arcpy.GetCount_management(layer)[0])
+                timings.append(('query', time.time() - t0))
+                items = int(arcpy.GetCount_management(md)[0])
+                log.Message(("{} layout: {} catalog item(s), {} at the AOI centre, ".format(layout, items, hits) +
+                             ", ".join("{} {:.2f}s".format(name, seconds) for name, seconds in timings)),log.const_general_text)
+                arcpy.Delete_management(layer)
+            arcpy.env.overwriteOutput = False
+
+        except Exception as exp:
+            log.Message(str(exp),2)
+            return False
+
+        return True
 
-                    except Exception as exp:
-                        log.Message('faield to Update: ' + str(row[0]),1 )
-        except:
+
+    def mrfTemplateBenchmark(self, data):
+        # renders benchmark_rows (default 150000) descriptors with the pre-split templates and with a full str.format
+        # of the template per call, and checks both produce the same text.
+        log = data['log']
+        try:
+            rowCount = int(self.getConfigValue(data, 'benchmark_rows', 150000))
+            results = sentinelBench.benchmarkMRF(self.getMRFTemplate(data), rowCount)
+            log.Message(("MRF descriptors for {} rows: render {:.2f}s, format {:.2f}s, identical output: {}".format(
+                rowCount, results['render'], results['format'], results['match'])),log.const_general_text)
+
+        except Exception as exp:
+            log.Message(str(exp),2)
+            return False
+
+        return True
+
+    def sourceProfileBenchmark(self, data):
+        # tile read latency (open, p50, p95) of <benchmark_profiles> (default all defined profiles) against a local S3
+        # compatible stand-in serving Parameter/Benchmark/S3, with <benchmark_latency_ms> (default 20) added per request.
+        # The COG is <benchmark_cog>, or a synthetic 5490x5490 UInt16 COG (512 tiles, DEFLATE, overviews) made once.
+        # The stand-in speaks HTTP/1.1, GDAL_HTTP_MULTIPLEX only pays off against HTTP/2 endpoints such as S3 itself.
+        log = data['log']
+        base = data['base']
+        try:
+            if sentinelLib.gdal is None:
+                log.Message(("sourceProfileBenchmark needs the GDAL python bindings (osgeo)"),2)
+                return False
+            benchPath = os.path.join(base.const_import_geometry_features_path_, 'Benchmark', 'S3')
+            bucket, key = 'sentinel-cogs', 'benchmark/B05.tif'
+            cogPath = os.path.join(benchPath, bucket, *key.split('/'))
+            sentinelBench.stageBenchmarkCog(cogPath, self.getConfigValue(data, 'benchmark_cog', None))
+            profiles = self.getSourceProfiles(data)
+            names = [name.strip() for name in self.getConfigValue(data, 'benchmark_profiles', ','.join(sorted(profiles))).split(',')]
+            tiles = int(self.getConfigValue(data, 'benchmark_tiles', 64))
+            latency = float(self.getConfigValue(data, 'benchmark_latency_ms', 20)) / 1000.0
+            standIn = sentinelBench.S3StandIn(benchPath, latency).start()
+            try:
+                results = sentinelBench.benchmarkProfiles([profiles[name] for name in names], standIn, bucket, key, tiles)
+            finally:
+                standIn.stop()
+            log.Message(("Tile reads of {} ({} tiles, {:.0f} ms per request):".format(key, tiles, latency * 1000)),log.const_general_text)
+            for name, result in results:
+                log.Message(("  {}: open {:.1f} ms, p50 {:.1f} ms, p95 {:.1f} ms, {} request(s), {:.1f} MB".format(
+                    name, result['open'], result['p50'], result['p95'], result['requests'], result['bytes'] / 1048576.0)),log.const_general_text)
+
+        except Exception as exp:
+            log.Message(str(exp),2)
             return False
 
         return True
@@ -0,0 +1,269 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Esri
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# Name: sentinelBench.py
+# Description: Benchmark helpers and the local S3 compatible stand-in used by the benchmark commands in MDCS_UC.py
+#              and the sentinelLib checks. Nothing in here depends on arcpy.
+# Version: 20210211
+# Requirements: Python 3
+# Author: Esri Imagery Workflows team
+# ------------------------------------------------------------------------------
+#!/usr/bin/env python
+import os
+import json
+import time
+import hashlib
+import shutil
+import threading
+import numpy as np
+from sentinelLib import BANDS, CFULL_TILE_KM2, SourceProfile, buildSceneBatch, scoreScenes, gdal
+
+
+def benchmarkScoring(engine, rows=1000000, repeat=5, seed=0):
+    # scores (rows) synthetic scenes, returns the best of (repeat) timings in seconds and whether the engine agrees
+    # with the reference scoreScenes implementation (meaningful for the default expression only).
+    rng = np.random.default_rng(seed)
+    acqDatetime = np.datetime64('2017-01-01T00:00:00', 's') + rng.integers(0, 3000 * 86400, rows).astype('timedelta64[s]')
+    cloud = rng.uniform(0, 100, rows)
+    area = rng.uniform(0, 1.2 * CFULL_TILE_KM2, rows) * 1000000
+    nodata = rng.uniform(0, 100, rows)
+    best = None
+    for i in range(max(1, int(repeat))):
+        t0 = time.perf_counter()
+        scores = engine.score(acqDatetime, cloud, area, nodata)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, bool(np.array_equal(scores, scoreScenes(acqDatetime, cloud, area)))
+
+
+def benchmarkPayloads(recordings, repeat=5):
+    # recordings: {name: [raw page JSON text, ...]} recorded from the same search with and without field projection.
+    # Returns {name: {'pages', 'items', 'bytes', 'parse_s', 'convert_s'}}, timings are the best of (repeat) runs.
+    results = {}
+    for name, texts in recordings.items():
+        best_parse = None
+        best_convert = None
+        items = 0
+        for i in range(max(1, int(repeat))):
+            t0 = time.perf_counter()
+            pages = [json.loads(text) for text in texts]
+            t1 = time.perf_counter()
+            items = 0
+            for page in pages:
+                items += len(buildSceneBatch(page['features']))
+            t2 = time.perf_counter()
+            best_parse = t1 - t0 if best_parse is None else min(best_parse, t1 - t0)
+            best_convert = t2 - t1 if best_convert is None else min(best_convert, t2 - t1)
+        results[name] = {'pages': len(texts), 'items': items, 'bytes': sum(len(text.encode('utf-8')) for text in texts),
+                         'parse_s': best_parse, 'convert_s': best_convert}
+    return results
+
+
+def benchmarkMRF(template, rows=150000, repeat=3):
+    # renders (rows) descriptors with render() and with format(), returns best timings and whether the outputs agree.
+    productUrl = 'https://sentinel-cogs.s3.us-west-2.amazonaws.com/sentinel-s2-l2a-cogs/13/S/DA/2023/7/S2B_13SDA_20230701_{}_L2A/'
+    args = [(productUrl.format(i // len(BANDS)), '409800.0', '4400040.0', '300000.0', '4290240.0', 'EPSG:32613',
+             BANDS[i % len(BANDS)]) for i in range(rows)]
+    results = {}
+    for name in ('render', 'format'):
+        fn = getattr(template, name)
+        best = None
+        for r in range(max(1, int(repeat))):
+            t0 = time.perf_counter()
+            for a in args:
+                fn(*a)
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = best
+    results['match'] = all(template.render(*a) == template.format(*a) for a in args[:len(BANDS) * 4])
+    return results
+
+
+class S3StandIn(object):
+    # local S3 compatible stand-in for benchmarks: serves root/<bucket>/<key> path style over HTTP/1.1 with HEAD,
+    # single and multiple byte ranges, anonymous only. latency (seconds) is added to every request to model the round
+    # trip to the bucket, requests and bytes sent are counted.
+
+    def __init__(self, root, latency=0.0, port=0):
+        import http.server
+        standIn = self
+        self.m_root = root
+        self.m_latency = latency
+        self.m_lock = threading.Lock()
+        self.m_requests = 0
+        self.m_bytes = 0
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.reply(False)
+
+            def do_GET(self):
+                self.reply(True)
+
+            def reply(self, body):
+                if standIn.m_latency:
+                    time.sleep(standIn.m_latency)
+                path = os.path.join(standIn.m_root, *[p for p in self.path.split('?', 1)[0].split('/') if p and p != '..'])
+                if not os.path.isfile(path):
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                size = os.path.getsize(path)
+                ranges = []
+                header = self.headers.get('Range')
+                if header and header.startswith('bytes='):
+                    for part in header[len('bytes='):].split(','):
+                        start, _, end = part.strip().partition('-')
+                        if start:
+                            start, end = int(start), min(int(end), size - 1) if end else size - 1
+                        else:       # suffix range, the last <end> bytes
+                            start, end = max(size - int(end), 0), size - 1
+                        if start < size:
+                            ranges.append((start, end))
+                if header and not ranges:
+                    self.send_response(416)        # S3 answers a range past the end with 416
+                    self.send_header('Content-Range', 'bytes */{}'.format(size))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                with open(path, 'rb') as f:
+                    if not ranges:
+                        self.send_response(200)
+                        payload = f.read() if body else b''
+                        self.send_header('Content-Length', str(size))
+                    elif len(ranges) == 1:
+                        start, end = ranges[0]
+                        self.send_response(206)
+                        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+                        f.seek(start)
+                        payload = f.read(end - start + 1) if body else b''
+                        self.send_header('Content-Length', str(end - start + 1))
+                    else:
+                        boundary = 'standin' + hashlib.sha1(header.encode('utf-8')).hexdigest()[:16]
+                        chunks = []
+                        for start, end in ranges:
+                            f.seek(start)
+                            chunks.append('--{}\r\nContent-Type: application/octet-stream\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                                boundary, start, end, size).encode('ascii') + f.read(end - start + 1) + b'\r\n')
+                        chunks.append('--{}--\r\n'.format(boundary).encode('ascii'))
+                        payload = b''.join(chunks)
+                        self.send_response(206)
+                        self.send_header('Content-Type', 'multipart/byteranges; boundary=' + boundary)
+                        self.send_header('Content-Length', str(len(payload)))
+                        if not body:
+                            payload = b''
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', '"{}"'.format(int(os.path.getmtime(path))))
+                with standIn.m_lock:        # counted before the reply, the client may read the counters right after it
+                    standIn.m_requests += 1
+                    standIn.m_bytes += len(payload)
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.m_server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.m_server.daemon_threads = True
+        self.endpoint = '127.0.0.1:{}'.format(self.m_server.server_address[1])
+        self.m_thread = threading.Thread(target=self.m_server.serve_forever, daemon=True)
+
+    def start(self):
+        self.m_thread.start()
+        return self
+
+    def stop(self):
+        self.m_server.shutdown()
+        self.m_server.server_close()
+
+    def counters(self, reset=False):
+        with self.m_lock:
+            counts = (self.m_requests, self.m_bytes)
+            if reset:
+                self.m_requests = self.m_bytes = 0
+        return counts
+
+
+def tileReadLatency(path, tiles=64, seed=0):
+    # opens path through GDAL and reads tiles random blocks of band 1, half at full resolution and half from the first
+    # overview. Returns {'open': ms, 'p50': ms, 'p95': ms, 'mean': ms}.
+    if gdal is None:
+        raise ImportError('tileReadLatency needs the GDAL python bindings (osgeo)')
+    t0 = time.perf_counter()
+    ds = gdal.Open(path)
+    if ds is None:
+        raise IOError('Unable to open ' + path)
+    band = ds.GetRasterBand(1)
+    opened = (time.perf_counter() - t0) * 1000.0
+    rng = np.random.default_rng(seed)
+    targets = [band] + ([band.GetOverview(0)] if band.GetOverviewCount() else [])
+    timings = []
+    for i in range(tiles):
+        target = targets[i % len(targets)]
+        blockX, blockY = target.GetBlockSize()
+        xOff = int(rng.integers(0, (target.XSize + blockX - 1) // blockX)) * blockX
+        yOff = int(rng.integers(0, (target.YSize + blockY - 1) // blockY)) * blockY
+        t0 = time.perf_counter()
+        target.ReadRaster(xOff, yOff, min(blockX, target.XSize - xOff), min(blockY, target.YSize - yOff))
+        timings.append((time.perf_counter() - t0) * 1000.0)
+    ds = None
+    timings = np.array(timings)
+    return {'open': opened, 'p50': float(np.percentile(timings, 50)), 'p95': float(np.percentile(timings, 95)),
+            'mean': float(timings.mean())}
+
+
+def stageBenchmarkCog(path, sourceCog=None, size=5490):
+    # copies sourceCog to path, or makes a synthetic UInt16 COG there (512 tiles, DEFLATE, overviews) once.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if sourceCog is not None:
+        shutil.copyfile(sourceCog, path)
+        return path
+    if os.path.exists(path):
+        return path
+    if gdal is None:
+        raise ImportError('stageBenchmarkCog needs the GDAL python bindings (osgeo)')
+    y, x = np.mgrid[0:size, 0:size]
+    pixels = (2000 + 800 * np.sin(x / 97.0) * np.cos(y / 131.0) +
+              np.random.default_rng(0).integers(0, 200, (size, size))).astype(np.uint16)
+    mem = gdal.GetDriverByName('MEM').Create('', size, size, 1, gdal.GDT_UInt16)
+    mem.GetRasterBand(1).WriteArray(pixels)
+    gdal.Translate(path, mem, format='COG', creationOptions=['BLOCKSIZE=512', 'COMPRESS=DEFLATE', 'OVERVIEWS=AUTO'])
+    return path
+
+
+def benchmarkProfiles(profiles, standIn, bucket, key, tiles=64):
+    # tile read latency of the COG <standIn root>/<bucket>/<key> per SourceProfile. Each profile is pointed at the
+    # stand-in (S3 profiles through AWS_S3_ENDPOINT, path style, over HTTP), applied, read cold (GDAL caches cleared)
+    # and restored. Returns [(profile name, latency dict with the requests and bytes the stand-in served)].
+    if gdal is None:
+        raise ImportError('benchmarkProfiles needs the GDAL python bindings (osgeo)')
+    url = 'http://{}/{}/{}'.format(standIn.endpoint, bucket, key)
+    results = []
+    for profile in profiles:
+        local = SourceProfile(profile.m_name, profile.m_scheme, profile.m_region or 'us-east-1', 'unsigned',
+                              standIn.endpoint, False, profile.m_multiplex, profile.m_merge_ranges,
+                              profile.m_vsi_cache_mb, profile.m_allowed_extensions)
+        previous = local.apply()
+        try:
+            gdal.VSICurlClearCache()
+            standIn.counters(reset=True)
+            latency = tileReadLatency(local.source(url), tiles)
+            latency['requests'], latency['bytes'] = standIn.counters()
+        finally:
+            SourceProfile.restore(previous)
+        results.append((profile.m_name, latency))
+    return results
@@ -0,0 +1,1816 @@
+# ------------------------------------------------------------------------------
+# Copyright 2021 Esri
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+# Name: sentinelLib.py
+# Description: Helpers used by the Sentinel-2 user commands in MDCS_UC.py. Nothing in here depends on arcpy.
+# Version: 20210211
+# Requirements: Python 3
+# Author: Esri Imagery Workflows team
+# ------------------------------------------------------------------------------
+#!/usr/bin/env python
+import os
+import ast
+import math
+import json
+import time
+import queue
+import shutil
+import hashlib
+import threading
+from datetime import datetime
+from datetime import timedelta
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from osgeo import gdal          # optional, only needed by CachePrewarmer.
+except ImportError:
+    gdal = None
+
+
+class StageStats(object):
+
+    def __init__(self, name):
+        self.m_name = name
+        self.m_items = 0
+        self.m_batches = 0
+        self.m_busy = 0.0
+        self.m_max_depth = 0
+        self.m_depth_total = 0
+        self.m_depth_samples = 0
+        self.m_lock = threading.Lock()
+
+    def add(self, items, busy):
+        with self.m_lock:
+            self.m_items += items
+            self.m_batches += 1
+            self.m_busy += busy
+
+    def sampleDepth(self, depth):
+        with self.m_lock:
+            self.m_depth_total += depth
+            self.m_depth_samples += 1
+            if depth > self.m_max_depth:
+                self.m_max_depth = depth
+
+    def report(self):
+        rate = self.m_items / self.m_busy if self.m_busy > 0 else 0
+        avgDepth = float(self.m_depth_total) / self.m_depth_samples if self.m_depth_samples else 0
+        return '{}: {} items in {} batches, {:.2f}s busy, {:.1f} items/s, queue depth avg {:.1f} max {}'.format(
+            self.m_name, self.m_items, self.m_batches, self.m_busy, rate, avgDepth, self.m_max_depth)
+
+
+class IngestPipeline(object):
+    # page fetcher -> item to row converter -> writer.
+    # Each task (e.g. a date interval) gets its own bounded page queue. Tasks are fetched concurrently but drained
+    # strictly in task order, so the output order is deterministic and at most (workers * prefetch) pages are held in memory.
+
+    CEND = object()
+
+    def __init__(self, fetchPages, convertPage, workers=4, prefetch=2, rowQueueSize=8):
+        self.m_fetch_pages = fetchPages         # fn(task) -> iterable of pages (lists of items)
+        self.m_convert_page = convertPage       # fn(page) -> list of rows
+        self.m_workers = max(1, int(workers))
+        self.m_prefetch = max(1, int(prefetch))
+        self.m_row_queue = queue.Queue(maxsize=max(1, int(rowQueueSize)))
+        self.m_stop = threading.Event()
+        self.m_cancel = threading.Event()       # set once the converter is done with the page queues, releases the producers
+        self.fetchStats = StageStats('fetch')
+        self.convertStats = StageStats('convert')
+        self.writeStats = StageStats('write')
+
+    def _put(self, q, value, stats, cancel=None):
+        while not self.m_stop.is_set() and not (cancel is not None and cancel.is_set()):
+            try:
+                q.put(value, timeout=0.5)
+                stats.sampleDepth(q.qsize())
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, task, q):
+        try:
+            pages = iter(self.m_fetch_pages(task))
+            while not self.m_stop.is_set() and not self.m_cancel.is_set():
+                t0 = time.time()
+                try:
+                    page = next(pages)
+                except StopIteration:
+                    break
+                self.fetchStats.add(len(page), time.time() - t0)
+                if not self._put(q, ('page', page), self.fetchStats, self.m_cancel):
+                    return
+        except Exception as exp:
+            self._put(q, ('error', exp), self.fetchStats, self.m_cancel)
+        self._put(q, self.CEND, self.fetchStats, self.m_cancel)
+
+    def _convert(self, tasks):
+        try:
+            with ThreadPoolExecutor(max_workers=self.m_workers) as executor:
+                taskQueues = []
+                for task in tasks:
+                    q = queue.Queue(maxsize=self.m_prefetch)
+                    taskQueues.append((task, q))
+                    executor.submit(self._produce, task, q)
+                try:
+                    self._drain(taskQueues)
+                finally:
+                    # producers still blocked on a full page queue would keep the executor from shutting down.
+                    self.m_cancel.set()
+        except Exception as exp:
+            self._put(self.m_row_queue, ('error', None, exp), self.convertStats)
+        self._put(self.m_row_queue, self.CEND, self.convertStats)
+
+    def _drain(self, taskQueues):
+        for task, q in taskQueues:
+            if not self._put(self.m_row_queue, ('task', task, None), self.convertStats):
+                return
+            while not self.m_stop.is_set():
+                try:
+                    msg = q.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if msg is self.CEND:
+                    break
+                if msg[0] == 'error':
+                    self._put(self.m_row_queue, ('error', task, msg[1]), self.convertStats)
+                    continue
+                t0 = time.time()
+                try:
+                    rows = self.m_convert_page(msg[1])
+                except Exception as exp:        # a bad page is reported, the rest of the task is still converted
+                    self._put(self.m_row_queue, ('error', task, exp), self.convertStats)
+                    continue
+                self.convertStats.add(len(rows), time.time() - t0)
+                self._put(self.m_row_queue, ('rows', task, rows), self.convertStats)
+
+    def run(self, tasks):
+        # generator to be consumed by the writer on the calling thread (arcpy cursors are not shared across threads).
+        # yields ('task', task, None) when a new task starts, ('rows', task, rows) and ('error', task, exception).
+        converter = threading.Thread(target=self._convert, args=(list(tasks),))
+        converter.daemon = True
+        converter.start()
+        try:
+            while True:
+                msg = self.m_row_queue.get()
+                if msg is self.CEND:
+                    break
+                yield msg
+        finally:
+            self.m_stop.set()
+            while not self.m_row_queue.empty():
+                self.m_row_queue.get_nowait()
+            converter.join()
+
+    def report(self):
+        return [self.fetchStats.report(), self.convertStats.report(), self.writeStats.report()]
+
+
+def windowEnd(dateTime):
+    # end of a STAC datetime interval ('2023-07-01/2023-07-31' or full ISO timestamps), None if open ended.
+    end = dateTime.split('/')[-1].strip()
+    if end in ('', '..'):
+        return None
+    end = end.replace('Z', '')
+    if 'T' in end:
+        return datetime.strptime(end[:19], '%Y-%m-%dT%H:%M:%S')
+    return datetime.strptime(end[:10], '%Y-%m-%d') + timedelta(days=1)
+
+
+class StacCache(object):
+    # on-disk cache of STAC search results, one JSON file per (endpoint, collection, intersects, datetime, query).
+    # Windows that closed more than settleDays ago are treated as immutable, recent windows expire after ttl seconds.
+    # Entries are written to a temporary file and renamed into place so several machines can share the same folder.
+
+    def __init__(self, root, ttl=86400, settleDays=7):
+        self.m_root = root
+        self.m_ttl = ttl
+        self.m_settle_days = settleDays
+
+    def key(self, endpoint, collection, intersects, dateTime, query, **kwargs):
+        request = {'endpoint': endpoint, 'collection': collection, 'intersects': intersects, 'datetime': dateTime, 'query': query}
+        request.update(kwargs)
+        return hashlib.sha1(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.m_root, key[:2], key + '.json')
+
+    def isClosed(self, dateTime):
+        end = windowEnd(dateTime)
+        return end is not None and end + timedelta(days=self.m_settle_days) < datetime.utcnow()
+
+    def get(self, key):
+        # returns (entry, fresh) or (None, False). Stale entries are returned so the caller can revalidate them.
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return (None, False)
+        meta = entry['meta']
+        fresh = meta['closed'] or (time.time() - meta['created']) < self.m_ttl
+        return (entry, fresh)
+
+    def put(self, key, dateTime, pages, matched=None):
+        path = self._path(key)
+        entry = {'meta': {'datetime': dateTime, 'created': time.time(), 'closed': self.isClosed(dateTime), 'matched': matched},
+                 'pages': pages}
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+            with open(tmp, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp, path)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def touch(self, key, entry):
+        return self.put(key, entry['meta']['datetime'], entry['pages'], entry['meta']['matched'])
+
+
+class Watermark(object):
+    # persisted high-water mark of the newest STAC item (properties.datetime / properties.updated) ingested for an AOI.
+
+    CLOOKBACK_DAYS = 3      # items can be published a few days after acquisition, re-search this far behind the mark.
+
+    def __init__(self, path):
+        self.m_path = path
+        self.m_datetime = None
+        self.m_updated = None
+        self.m_new_datetime = None
+        self.m_new_updated = None
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load(self):
+        try:
+            with open(self.m_path, 'r') as f:
+                mark = json.load(f)
+            self.m_datetime = mark.get('datetime')
+            self.m_updated = mark.get('updated')
+        except (IOError, OSError, ValueError):
+            return False
+        return True
+
+    def searchStart(self):
+        mark = datetime.strptime(self.m_datetime[:10], '%Y-%m-%d') - timedelta(days=self.CLOOKBACK_DAYS)
+        return mark.strftime('%Y-%m-%d')
+
+    def isNew(self, item):
+        if self.m_datetime is None:
+            return True
+        props = item['properties']
+        if props.get('datetime', '') > self.m_datetime:
+            return True
+        updated = props.get('updated')
+        return updated is not None and self.m_updated is not None and updated > self.m_updated
+
+    def observe(self, item):
+        props = item['properties']
+        itemDatetime = props.get('datetime')
+        updated = props.get('updated')
+        if itemDatetime is not None and (self.m_new_datetime is None or itemDatetime > self.m_new_datetime):
+            self.m_new_datetime = itemDatetime
+        if updated is not None and (self.m_new_updated is None or updated > self.m_new_updated):
+            self.m_new_updated = updated
+
+    def save(self, **kwargs):
+        if self.m_new_datetime is None:
+            return False        # nothing new was seen, keep the previous mark.
+        mark = {'datetime': max(self.m_new_datetime, self.m_datetime or ''),
+                'updated': max(self.m_new_updated or '', self.m_updated or '') or None,
+                'saved': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
+        mark.update(kwargs)
+        try:
+            if not os.path.exists(os.path.dirname(self.m_path)):
+                os.makedirs(os.path.dirname(self.m_path), exist_ok=True)
+            tmp = self.m_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(mark, f, indent=2)
+            os.replace(tmp, self.m_path)
+        except (IOError, OSError):
+            return False
+        return True
+
+
+def _splitAxis(lo, hi, step, origin):
+    # edges between lo and hi falling on origin + n * step.
+    edges = [lo]
+    edge = origin + (math.floor((lo - origin) / step) + 1) * step
+    while edge < hi - 1e-9:
+        edges.append(edge)
+        edge += step
+    edges.append(hi)
+    return edges
+
+
+def splitAOI(bbox, mode):
+    # split [minx, miny, maxx, maxy] into cells. mode:
+    #   'grid:<deg>'  fixed-degree cells aligned to whole multiples of <deg>.
+    #   'gzd'         MGRS grid zone designations (6 degree UTM zones x 8 degree latitude bands), only splits AOIs that
+    #                 cross a zone boundary, not into the 100km Sentinel-2 tiles.
+    #   'gzd:<deg>'   grid zones further split into <deg> cells aligned to the zone origin.
+    minX, minY, maxX, maxY = [float(v) for v in bbox]
+    mode = (mode or '').strip().lower()
+    if mode in ('', '#', 'none'):
+        return [[minX, minY, maxX, maxY]]
+    kind, _, size = mode.partition(':')
+    if kind == 'grid':
+        xEdges = _splitAxis(minX, maxX, float(size), 0.0)
+        yEdges = _splitAxis(minY, maxY, float(size), 0.0)
+    elif kind == 'gzd':
+        xEdges = _splitAxis(minX, maxX, 6.0, -180.0)
+        yEdges = _splitAxis(minY, maxY, 8.0, -80.0)
+        if size:
+            xEdges = sorted(set(e for x0, x1 in zip(xEdges[:-1], xEdges[1:]) for e in _splitAxis(x0, x1, float(size), -180.0)))
+            yEdges = sorted(set(e for y0, y1 in zip(yEdges[:-1], yEdges[1:]) for e in _splitAxis(y0, y1, float(size), -80.0)))
+    else:
+        raise ValueError('Invalid AOI tiling mode ({})'.format(mode))
+    cells = []
+    for y0, y1 in zip(yEdges[:-1], yEdges[1:]):
+        for x0, x1 in zip(xEdges[:-1], xEdges[1:]):
+            cells.append([x0, y0, x1, y1])
+    return cells
+
+
+def bboxPolygon(bbox):
+    return {
+        "type": "Polygon",
+        "coordinates": [[
+            [bbox[0], bbox[1]],
+            [bbox[2], bbox[1]],
+            [bbox[2], bbox[3]],
+            [bbox[0], bbox[3]],
+            [bbox[0], bbox[1]]
+        ]]
+    }
+
+
+class TokenBucket(object):
+    # thread-safe token bucket, acquire() blocks until a token is available. rate <= 0 disables limiting.
+
+    def __init__(self, rate, burst=None):
+        self.m_rate = float(rate)
+        self.m_capacity = float(burst) if burst else max(1.0, self.m_rate)
+        self.m_tokens = self.m_capacity
+        self.m_last = time.time()
+        self.m_lock = threading.Lock()
+
+    def acquire(self):
+        if self.m_rate <= 0:
+            return
+        while True:
+            with self.m_lock:
+                now = time.time()
+                self.m_tokens = min(self.m_capacity, self.m_tokens + (now - self.m_last) * self.m_rate)
+                self.m_last = now
+                if self.m_tokens >= 1.0:
+                    self.m_tokens -= 1.0
+                    return
+                wait = (1.0 - self.m_tokens) / self.m_rate
+            time.sleep(wait)
+
+
+# item fields read by buildSceneBatch, requested through the STAC fields extension to shrink search payloads.
+CSTAC_FIELDS = [
+    'id',
+    'bbox',
+    'geometry',
+    'properties.datetime',
+    'properties.updated',
+    'properties.eo:cloud_cover',
+    'properties.proj:epsg',
+    'properties.s2:product_uri',
+    'properties.sentinel:product_id',
+    'properties.constellation',
+    'properties.s2:nodata_pixel_percentage',
+    'assets.visual.href',
+    'assets.visual.proj:shape',
+    'assets.visual.proj:transform',
+]
+
+
+class SceneBatch(object):
+    # columnar record batch for a page of STAC items. Footprints are stored as one coordinate buffer (coords)
+    # with per-scene ring offsets, scene i owns coords[ringOffsets[i]:ringOffsets[i + 1]].
+
+    def __init__(self):
+        self.id = []
+        self.productId = []
+        self.productUrl = []
+        self.constellation = []
+        self.acqDate = []                               # 'YYYY-MM-DD HH:MM:SS'
+        self.datetime = np.zeros(0, 'datetime64[s]')
+        self.numDate = np.zeros(0, np.int64)
+        self.cloud = np.zeros(0, np.float64)
+        self.nodata = np.zeros(0, np.float64)          # s2:nodata_pixel_percentage, NaN when the item has none
+        self.epsg = np.zeros(0, np.int64)
+        self.bbox = np.zeros((0, 4), np.float64)        # minx, miny, maxx, maxy (WGS84)
+        self.shape = np.zeros((0, 2), np.int64)         # proj:shape of the visual asset
+        self.transform = np.zeros((0, 6), np.float64)   # proj:transform of the visual asset
+        self.proxyBBox = np.zeros((0, 4), np.float64)   # maxx, maxy, minx, miny in the scene projection
+        self.coords = np.zeros((0, 2), np.float64)
+        self.ringOffsets = np.zeros(1, np.int64)
+        self.errors = []                                # (item id, message) for items that could not be read
+
+    def __len__(self):
+        return len(self.id)
+
+    def ring(self, i):
+        return self.coords[self.ringOffsets[i]:self.ringOffsets[i + 1]]
+
+
+def _exteriorRing(geometry):
+    coordinates = geometry['coordinates']
+    if geometry['type'] == 'MultiPolygon':
+        coordinates = max(coordinates, key=lambda polygon: len(polygon[0]))     # largest part
+    ring = coordinates[0]
+    if ring[0] != ring[-1]:
+        ring = ring + [ring[0]]     # close the polygon
+    return ring
+
+
+def buildSceneBatch(items):
+    # items: list of STAC item dicts (earth-search v1, or v0 items carrying sentinel:product_id).
+    batch = SceneBatch()
+    datetimes = []
+    cloud = []
+    nodata = []
+    epsg = []
+    bbox = []
+    shape = []
+    transform = []
+    rings = []
+    for item in items:
+        try:
+            props = item['properties']
+            visual = item['assets']['visual']
+            itemDatetime = props['datetime']
+            productId = props.get('s2:product_uri', props.get('sentinel:product_id'))
+            ring = _exteriorRing(item['geometry'])
+            row = (float(props['eo:cloud_cover']), int(props['proj:epsg']), [float(v) for v in item['bbox'][:4]],
+                   [int(v) for v in visual['proj:shape'][:2]], [float(v) for v in visual['proj:transform'][:6]])
+            href = visual['href']
+        except (KeyError, IndexError, TypeError, ValueError) as exp:
+            batch.errors.append((item.get('id') if isinstance(item, dict) else None, 'missing/invalid {}'.format(exp)))
+            continue
+        batch.id.append(item['id'])
+        batch.productId.append(productId)
+        batch.productUrl.append(href[:-7])        # strip 'TCI.tif'
+        batch.constellation.append(props.get('constellation'))
+        batch.acqDate.append(itemDatetime[0:10] + ' ' + itemDatetime[11:19])
+        datetimes.append(itemDatetime[0:19])
+        cloud.append(row[0])
+        nodata.append(props.get('s2:nodata_pixel_percentage'))
+        epsg.append(row[1])
+        bbox.append(row[2])
+        shape.append(row[3])
+        transform.append(row[4])
+        rings.append(ring)
+    n = len(batch.id)
+    if n == 0:
+        return batch
+    batch.datetime = np.array(datetimes, 'datetime64[s]')
+    days = batch.datetime.astype('datetime64[D]')
+    years = days.astype('datetime64[Y]').astype(np.int64) + 1970
+    months = days.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    dom = (days - days.astype('datetime64[M]')).astype(np.int64) + 1
+    batch.numDate = years * 10000 + months * 100 + dom
+    batch.cloud = np.array(cloud, np.float64)
+    batch.nodata = np.array([np.nan if v is None else v for v in nodata], np.float64)
+    batch.epsg = np.array(epsg, np.int64)
+    batch.bbox = np.array(bbox, np.float64)
+    batch.shape = np.array(shape, np.int64).reshape(-1, 2)
+    batch.transform = np.array(transform, np.float64)
+    minX = batch.transform[:, 2]
+    maxY = batch.transform[:, 5]
+    extent = batch.shape[:, 0] * batch.transform[:, 0]
+    batch.proxyBBox = np.column_stack((minX + extent, maxY, minX, maxY - extent))
+    lengths = np.array([len(ring) for ring in rings], np.int64)
+    batch.ringOffsets = np.concatenate(([0], np.cumsum(lengths)))
+    batch.coords = np.array([xy[:2] for ring in rings for xy in ring], np.float64).reshape(-1, 2)
+    return batch
+
+
+def joinValues(values):
+    # comma separated text of the float values, formatted as str(float) to match the existing *_BB_Values fields.
+    return ','.join(str(v) for v in values)
+
+
+BANDS = ["B01","B02","B03","B04","B05","B06","B07","B08","B8A","B09","B11","B12","SCL","WVP","AOT"]
+CCOMPOSITE_BANDS = ["B01","B02","B03","B04","B05","B06","B07","B08","B8A","B09","B11","B12","AOT","WVP","SCL"]   # Sentinel2_MS.art.xml order
+BAND_SIZE = {"B01": 1830, "B09": 1830, "AOT": 1830, "B05": 5490, "B06": 5490, "B07": 5490, "B8A": 5490, "B11": 5490,
+             "B12": 5490, "SCL": 5490, "B02": 10980, "B03": 10980, "B04": 10980, "B08": 10980, "WVP": 10980}
+# per band raster description used by the caching MRF descriptors.
+BAND_INFO = dict((band, {'size': size, 'page': 512, 'compression': 'LERC', 'dataType': 'UInt16', 'rsetScale': 2})
+                 for band, size in BAND_SIZE.items())
+CWEB_MERCATOR_RADIUS = 6378137.0
+CFULL_TILE_KM2 = 12115.0       # footprint of a complete 110km granule in web mercator at the test latitudes.
+
+
+def ringAreas(batch):
+    # planar area (m2) of every footprint after projecting the WGS84 vertices to web mercator (3857), i.e. the
+    # Shape_Area the feature classes report for the same polygons.
+    if len(batch) == 0:
+        return np.zeros(0, np.float64)
+    lon = np.radians(batch.coords[:, 0])
+    lat = np.radians(np.clip(batch.coords[:, 1], -85.0511, 85.0511))
+    x = CWEB_MERCATOR_RADIUS * lon
+    y = CWEB_MERCATOR_RADIUS * np.log(np.tan(np.pi / 4 + lat / 2))
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    # drop the cross terms that straddle two rings, then sum per ring.
+    cross[batch.ringOffsets[1:-1] - 1] = 0
+    areas = np.add.reduceat(np.append(cross, 0.0), batch.ringOffsets[:-1])
+    return np.abs(areas) / 2
+
+
+def scoreScenes(acqDatetime, cloud, area):
+    # Q/Best score, lower is better. Newer scenes score lower, cloud cover pushes a scene back by up to 180 days
+    # and partial tiles by up to 60 (or 600 below 20% coverage) days. Returned rounded for the Long Q/Best fields.
+    days = (np.asarray(acqDatetime).astype('datetime64[D]') - np.datetime64('1899-12-31', 'D')).astype(np.float64)
+    cloudCover = np.nan_to_num(np.asarray(cloud, np.float64)) / 100.0 * 180
+    ratio = np.asarray(area, np.float64) / 1000000 / CFULL_TILE_KM2
+    areaEquDate = np.where(ratio <= 0.2, -(600 - ratio * 600), np.where(ratio <= 1.0, -(60 - ratio * 60), 0.0))
+    return np.rint((100000 - days + cloudCover) - areaEquDate).astype(np.int64)
+
+
+CSCORE_EXPRESSION = ('100000 - days + cloud / 100 * cloud_days'
+                     ' + where(area_ratio <= small_ratio, small_days * (1 - area_ratio),'
+                     ' where(area_ratio <= 1, partial_days * (1 - area_ratio), 0))')
+CSCORE_WEIGHTS = {'cloud_days': 180.0, 'partial_days': 60.0, 'small_days': 600.0, 'small_ratio': 0.2,
+                  'full_tile_km2': CFULL_TILE_KM2}
+CSCORE_DEFINES = [('area_ratio', 'area_km2 / full_tile_km2')]
+CSCORE_COLUMNS = ('days', 'cloud', 'area_km2', 'nodata', 'month', 'doy')
+CSCORE_FUNCTIONS = {'where': np.where, 'minimum': np.minimum, 'maximum': np.maximum, 'clip': np.clip, 'abs': np.abs,
+                    'log': np.log, 'exp': np.exp, 'sqrt': np.sqrt, 'floor': np.floor, 'ceil': np.ceil}
+_CSCORE_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Load, ast.Constant,
+                 ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd, ast.Invert,
+                 ast.BitAnd, ast.BitOr, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+
+class ScoringEngine(object):
+    # Q/Best ranking over column arrays, lower is better. The expression (and the optional defines, evaluated in
+    # order) may use the columns
+    #   days      days since 1899-12-31 of the acquisition date    cloud     eo:cloud_cover (0-100, missing = 0)
+    #   area_km2  footprint area in web mercator km2               nodata    s2:nodata_pixel_percentage (missing = 0)
+    #   month     acquisition month (1-12)                         doy       day of year (1-366)
+    # the weights, numbers and the functions in CSCORE_FUNCTIONS. Combine conditions with & and |, e.g.
+    # where((month >= 5) & (month <= 9), ...) for a growing season trade-off. The default reproduces the original
+    # findBestTiles formula. Expressions are checked and compiled once, evaluation is plain numpy.
+
+    def __init__(self, expression=CSCORE_EXPRESSION, weights=None, defines=None):
+        self.m_weights = dict(CSCORE_WEIGHTS)
+        self.m_weights.update(weights or {})
+        self.m_expression = expression
+        self.m_defines = []
+        known = set(CSCORE_COLUMNS) | set(self.m_weights) | set(CSCORE_FUNCTIONS)
+        self.m_columns = set()
+        for name, text in (CSCORE_DEFINES if defines is None else defines):
+            self.m_defines.append((name, self._compile(text, known)))
+            known.add(name)
+        self.m_code = self._compile(expression, known)
+
+    def _compile(self, text, known):
+        tree = ast.parse(text.strip(), mode='eval')
+        for node in ast.walk(tree):
+            if not isinstance(node, _CSCORE_NODES):
+                raise ValueError('Scoring: {} is not allowed in "{}"'.format(type(node).__name__, text))
+            if isinstance(node, ast.Name):
+                if node.id not in known:
+                    raise ValueError('Scoring: unknown name {} in "{}"'.format(node.id, text))
+                if node.id in CSCORE_COLUMNS:
+                    self.m_columns.add(node.id)
+            elif isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id in CSCORE_FUNCTIONS):
+                raise ValueError('Scoring: only {} can be called in "{}"'.format(', '.join(sorted(CSCORE_FUNCTIONS)), text))
+            elif isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError('Scoring: only numeric constants are allowed in "{}"'.format(text))
+        return compile(tree, '<Scoring>', 'eval')
+
+    def uses(self, column):
+        return column in self.m_columns
+
+    def score(self, acqDatetime, cloud, area, nodata=None):
+        # acqDatetime: datetime64 array, cloud: percent, area: m2 in web mercator, nodata: percent (optional).
+        days = np.asarray(acqDatetime).astype('datetime64[D]')
+        namespace = dict(CSCORE_FUNCTIONS)
+        namespace.update(self.m_weights)
+        namespace['cloud'] = np.nan_to_num(np.asarray(cloud, np.float64))
+        namespace['area_km2'] = np.asarray(area, np.float64) / 1000000
+        if 'days' in self.m_columns:
+            namespace['days'] = (days - np.datetime64('1899-12-31', 'D')).astype(np.float64)
+        if 'month' in self.m_columns:
+            namespace['month'] = days.astype('datetime64[M]').astype(np.int64) % 12 + 1
+        if 'doy' in self.m_columns:
+            namespace['doy'] = (days - days.astype('datetime64[Y]')).astype(np.int64) + 1
+        if 'nodata' in self.m_columns:
+            namespace['nodata'] = np.zeros(len(days)) if nodata is None else np.nan_to_num(np.asarray(nodata, np.float64))
+        for name, code in self.m_defines:
+            namespace[name] = eval(code, {'__builtins__': {}}, namespace)
+        result = np.broadcast_to(eval(self.m_code, {'__builtins__': {}}, namespace), days.shape)
+        return np.rint(np.nan_to_num(result)).astype(np.int64)
+
+
+def changedScores(q, best, scores):
+    # positions whose stored Q or Best differ from the freshly computed score, the only rows that need writing.
+    return np.nonzero((np.asarray(q) != scores) | (np.asarray(best) != scores))[0]
+
+
+def inClauses(field, values, size=1000):
+    # "<field> IN (...)" where-clauses over the integer values, at most size values per clause.
+    values = [int(v) for v in values]
+    return ['{} IN ({})'.format(field, ','.join(str(v) for v in values[i:i + size])) for i in range(0, len(values), size)]
+
+
+def duplicateLosers(oids, names, best, cloud, lastOID=0):
+    # duplicate catalog items by Name, only for the names of the items added after lastOID (the new items and the
+    # items they collide with). The best ranked item of a name (lowest Best, then CloudCover, then OID) is kept, the
+    # sorted OIDs of the others are returned with the number of names ranked. Items without a name are never duplicates.
+    oids = np.asarray(oids)
+    names = np.asarray(names)
+    touched = np.unique(names[(oids > lastOID) & (names != '')])
+    mask = np.isin(names, touched)
+    oids, names, best, cloud = oids[mask], names[mask], np.asarray(best)[mask], np.asarray(cloud)[mask]
+    order = np.lexsort((oids, cloud, best, names))
+    names = names[order]
+    first = np.ones(len(names), dtype=bool)
+    first[1:] = names[1:] != names[:-1]
+    return np.sort(oids[order][~first]), len(touched)
+
+
+def productKey(productUri):
+    # S2B_MSIL2A_20230701T174909_N0509_R141_T13SDA_20230702T001234.SAFE -> (S2B_MSIL2A_20230701T174909_R141_T13SDA, (N0509, 20230702T001234))
+    # the key identifies the datatake/tile, the rank orders its reprocessings (processing baseline, generation time).
+    if not productUri:
+        return (None, None)
+    parts = productUri.replace('.SAFE', '').split('_')
+    if len(parts) < 7:
+        return (productUri, ('', ''))
+    return ('_'.join(parts[0:3] + parts[4:6]), (parts[3], parts[6]))
+
+
+class SceneIndex(object):
+    # in-memory index of the scenes accepted during an ingest, used to drop duplicates before any row is written.
+    # Duplicate STAC ids are dropped as they arrive. With dedupeProduct, reprocessings of the same datatake/tile
+    # (same s2:product_uri apart from baseline and generation time) are resolved to the newest one, which can only
+    # be known once all items have been seen: accept() holds those items back, one per product (the newest so far),
+    # and flush() hands them out at the end. A product already in the output before this run is only taken in again
+    # for a newer reprocessing, the keys of its existing rows are then listed in m_superseded.
+
+    def __init__(self, dedupeProduct=False):
+        self.m_dedupe_product = dedupeProduct
+        self.m_ids = set()
+        self.m_pending = {}         # product key -> (rank, item), the newest reprocessing seen in this run
+        self.m_existing = {}        # product key -> (rank, [row key, ...]) for products in the output before this run
+        self.m_superseded = []      # row keys of existing rows replaced by a newer reprocessing
+        self.m_dropped = 0
+        self.m_lock = threading.Lock()
+
+    def addExisting(self, itemId, productUri=None, rowKey=None):
+        self.m_ids.add(itemId)
+        key, rank = productKey(productUri)
+        if key is not None:
+            current = self.m_existing.setdefault(key, (rank, []))
+            self.m_existing[key] = (max(rank, current[0]), current[1] + [rowKey])
+
+    def accept(self, item):
+        # True when the item can be written right away, False when it is a duplicate or held back for flush().
+        props = item.get('properties', {})
+        productUri = props.get('s2:product_uri', props.get('sentinel:product_id'))
+        with self.m_lock:
+            if item['id'] in self.m_ids:
+                self.m_dropped += 1
+                return False
+            self.m_ids.add(item['id'])
+            if not self.m_dedupe_product:
+                return True
+            key, rank = productKey(productUri)
+            if key is None:
+                return True
+            existing = self.m_existing.get(key)
+            if existing is not None and rank <= existing[0]:      # the output already has this or a newer reprocessing.
+                self.m_dropped += 1
+                return False
+            rank = rank + (props.get('updated', ''),)
+            current = self.m_pending.get(key)
+            if current is not None:
+                self.m_dropped += 1
+                if rank <= current[0]:
+                    return False
+            self.m_pending[key] = (rank, item)
+            return False
+
+    def flush(self):
+        # the held back items, once every item was seen. The existing rows of their products become superseded.
+        with self.m_lock:
+            items = [item for rank, item in self.m_pending.values()]
+            for key in self.m_pending:
+                if key in self.m_existing:
+                    self.m_superseded.extend(self.m_existing.pop(key)[1])
+            self.m_pending = {}
+        return items
+
+
+CWINDOW_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def formatWindow(start, end):
+    # [start, end) as an inclusive STAC datetime interval, so adjacent windows never share an instant.
+    return '{}/{}'.format(start.strftime(CWINDOW_FORMAT), (end - timedelta(seconds=1)).strftime(CWINDOW_FORMAT))
+
+
+def planWindows(start, end, intervals, countFn, budget, workers=4, minSpan=timedelta(days=1)):
+    # adaptive date windows for [start, end). Starts from (intervals) equal windows, bisects any window whose
+    # countFn(window) exceeds budget (down to minSpan) and merges neighbouring sparse windows while the sum stays
+    # within budget. Returns [(window, count)] in time order. A count of None (unknown) is never split or merged.
+    intervals = max(1, int(intervals))
+    days = (end - start).days
+    edges = [start + timedelta(days=(days * i) // intervals) for i in range(intervals)] + [end]
+    pending = [(w0, w1) for w0, w1 in zip(edges[:-1], edges[1:]) if w1 > w0]
+    planned = []
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+        while pending:
+            counts = list(executor.map(lambda w: countFn(formatWindow(w[0], w[1])), pending))
+            nextPending = []
+            for (w0, w1), count in zip(pending, counts):
+                if count is not None and count > budget and (w1 - w0) / 2 >= minSpan:
+                    mid = w0 + (w1 - w0) / 2
+                    mid = datetime(mid.year, mid.month, mid.day) if (mid - w0) >= timedelta(days=1) else mid
+                    nextPending.extend([(w0, mid), (mid, w1)])
+                else:
+                    planned.append((w0, w1, count))
+            pending = nextPending
+    planned.sort(key=lambda w: w[0])
+    merged = []
+    for w0, w1, count in planned:
+        if merged and count is not None and merged[-1][2] is not None and merged[-1][2] + count <= budget:
+            merged[-1] = (merged[-1][0], w1, merged[-1][2] + count)
+        else:
+            merged.append((w0, w1, count))
+    return [(formatWindow(w0, w1), count) for w0, w1, count in merged]
+
+
+class BatchWriter(object):
+    # buffers rows and hands them to insertRow in batches of batchSize. Each batch is wrapped in begin()/commit()
+    # (an edit operation for arcpy), rows that fail are appended to a JSON lines reject file instead of being logged,
+    # and a batch whose commit fails is rolled back with abort() and rejected as a whole. finish() runs on close().
+    # batchLog(name, rows, seconds, rejected) is called after every batch.
+
+    def __init__(self, name, insertRow, batchSize=1000, rejectPath=None, begin=None, commit=None, abort=None,
+                 finish=None, batchLog=None):
+        self.m_name = name
+        self.m_insert = insertRow
+        self.m_batch_size = max(1, int(batchSize))
+        self.m_reject_path = rejectPath
+        self.m_begin = begin
+        self.m_commit = commit
+        self.m_abort = abort
+        self.m_finish = finish
+        self.m_batch_log = batchLog
+        self.m_rows = []
+        self.m_written = 0
+        self.m_rejected = 0
+        self.m_reject_file = None
+        self.stats = StageStats(name)
+
+    def add(self, row):
+        self.m_rows.append(row)
+        if len(self.m_rows) >= self.m_batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.m_rows:
+            return
+        rows = self.m_rows
+        self.m_rows = []
+        t0 = time.perf_counter()
+        rejects = []
+        if self.m_begin is not None:
+            self.m_begin()
+        for row in rows:
+            try:
+                self.m_insert(row)
+            except Exception as exp:
+                rejects.append((row, exp))
+        try:
+            if self.m_commit is not None:
+                self.m_commit()
+        except Exception as exp:
+            if self.m_abort is not None:
+                try:
+                    self.m_abort()
+                except Exception:
+                    pass
+            rejects = [(row, exp) for row in rows]
+        for row, exp in rejects:
+            self.reject(row, exp)
+        elapsed = time.perf_counter() - t0
+        self.m_written += len(rows) - len(rejects)
+        self.stats.add(len(rows), elapsed)
+        if self.m_batch_log is not None:
+            self.m_batch_log(self.m_name, len(rows), elapsed, len(rejects))
+
+    def reject(self, row, exp):
+        self.m_rejected += 1
+        if self.m_reject_path is None:
+            return
+        if self.m_reject_file is None:
+            folder = os.path.dirname(self.m_reject_path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self.m_reject_file = open(self.m_reject_path, 'a')
+        # geometries are written as WKT when the value carries one (arcpy geometry), anything else as text.
+        values = [getattr(value, 'WKT', value) for value in row]
+        record = {'table': self.m_name, 'time': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                  'error': str(exp), 'row': values}
+        self.m_reject_file.write(json.dumps(record, default=str) + '\n')
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.m_reject_file is not None:
+                self.m_reject_file.close()
+                self.m_reject_file = None
+            if self.m_finish is not None:
+                self.m_finish()
+
+    def report(self):
+        rate = self.stats.m_items / self.stats.m_busy if self.stats.m_busy > 0 else 0
+        return '{}: {} rows in {} batches, {:.2f}s, {:.1f} rows/s ({} written, {} rejected)'.format(
+            self.m_name, self.stats.m_items, self.stats.m_batches, self.stats.m_busy, rate, self.m_written, self.m_rejected)
+
+
+class DescriptorStore(object):
+    # content-addressed sidecar store for MRF descriptors (and scene VRTs), <root>/ab/cd/abcd....mrf named by the
+    # SHA-1 of the text.
+    # A descriptor is written once and reused by every later put() of the same text, writes go through a temporary
+    # file and a rename so concurrent runs sharing the store never see partial files. migrateCacheLayout rewrites
+    # descriptors in place so the catalog items referencing them follow, such a file keeps the name of its original
+    # text: put() of that text returns the migrated descriptor (the same raster under the current cache layout and
+    # source profile), the store is only strictly content-addressed for files never migrated.
+
+    def __init__(self, root):
+        self.m_root = root
+        self.m_written = 0
+        self.m_reused = 0
+        self.m_bytes = 0
+
+    def path(self, text, ext='.mrf'):
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        return os.path.join(self.m_root, key[:2], key[2:4], key + ext)
+
+    def put(self, text, ext='.mrf'):
+        path = self.path(text, ext)
+        if os.path.exists(path):
+            self.m_reused += 1
+            return path
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+        self.m_written += 1
+        self.m_bytes += len(text)
+        return path
+
+    def report(self):
+        return 'MRF store {}: {} descriptor(s) written ({:.1f} KB), {} reused'.format(
+            self.m_root, self.m_written, self.m_bytes / 1024.0, self.m_reused)
+
+
+def folderSize(path):
+    # total size in bytes of the files below path (a file geodatabase is a folder).
+    total = 0
+    for folder, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(folder, name))
+            except OSError:
+                pass
+    return total
+
+
+CSCENE_RESAMPLING = ('nearest', 'bilinear', 'cubic', 'cubicspline', 'lanczos', 'average', 'mode')
+
+
+def checkSceneResampling(resampling):
+    if resampling not in CSCENE_RESAMPLING:
+        raise ValueError('Unknown scene resampling {}, expected one of {}'.format(resampling, ', '.join(CSCENE_RESAMPLING)))
+    return resampling
+
+
+def sceneVRT(sources, proxyBBox, epsg, resampling='nearest'):
+    # one 15 band VRT per scene on the 10m grid, bands in the Sentinel2_MS.art.xml composite order.
+    # sources: {band: GDAL path of the band raster}, proxyBBox: (maxx, maxy, minx, miny) in the scene projection.
+    # 20m and 60m bands are resampled to the 10m grid by their source window with resampling (one of
+    # CSCENE_RESAMPLING), nearest by default so reflectances are not blended. The SCL classes are always nearest.
+    checkSceneResampling(resampling)
+    size = BAND_SIZE["B02"]
+    maxX, maxY, minX, minY = [float(v) for v in proxyBBox]
+    lines = ['<VRTDataset rasterXSize="{0}" rasterYSize="{0}">'.format(size),
+             '  <SRS>EPSG:{}</SRS>'.format(int(epsg)),
+             '  <GeoTransform>{}, {}, 0.0, {}, 0.0, {}</GeoTransform>'.format(minX, (maxX - minX) / size, maxY, -(maxY - minY) / size)]
+    for i, band in enumerate(CCOMPOSITE_BANDS):
+        srcSize = BAND_SIZE[band]
+        lines.append('  <VRTRasterBand dataType="UInt16" band="{0}"><Description>{1}</Description><NoDataValue>0</NoDataValue>'
+                     '<SimpleSource resampling="{2}"><SourceFilename relativeToVRT="0">{3}</SourceFilename><SourceBand>1</SourceBand>'
+                     '<SrcRect xOff="0" yOff="0" xSize="{4}" ySize="{4}"/><DstRect xOff="0" yOff="0" xSize="{5}" ySize="{5}"/>'
+                     '</SimpleSource></VRTRasterBand>'.format(i + 1, band, 'nearest' if band == 'SCL' else resampling,
+                                                              sources[band], srcSize, size))
+    lines.append('</VRTDataset>')
+    return '\n'.join(lines) + '\n'
+
+
+def s3Location(url, endpoint=None):
+    # (bucket, key, region) of an S3 object URL, virtual hosted (https://<bucket>.s3.<region>.amazonaws.com/<key>) or
+    # path style (https://s3.<region>.amazonaws.com/<bucket>/<key>, or <endpoint>/<bucket>/<key>), None otherwise.
+    scheme, sep, rest = url.partition('://')
+    if not sep:
+        return None
+    host, _, path = rest.partition('/')
+    if endpoint is not None and host == endpoint:
+        bucket, _, key = path.partition('/')
+        return bucket, key, None
+    if not host.endswith('.amazonaws.com'):
+        return None
+    labels = host[:-len('.amazonaws.com')].split('.')
+    if 's3' not in labels and not any(label.startswith('s3-') for label in labels):
+        return None
+    index = [i for i, label in enumerate(labels) if label == 's3' or label.startswith('s3-')][0]
+    region = labels[index + 1] if index + 1 < len(labels) else (labels[index][3:] or None)
+    if index > 0:
+        return '.'.join(labels[:index]), path, region
+    bucket, _, key = path.partition('/')
+    return bucket, key, region
+
+
+class SourceProfile(object):
+    # how GDAL reaches the band COGs: the source path written into the MRF descriptors and scene VRTs, and the GDAL
+    # network options set in the process environment. scheme 'vsicurl' reads the HTTPS URL, 'vsis3' reads S3 URLs
+    # natively with access 'unsigned' (AWS_NO_SIGN_REQUEST), 'requester-pays' or 'signed' (credentials from the
+    # usual AWS environment/profile), other URLs stay on /vsicurl/. endpoint (host:port) targets an S3 compatible
+    # server, path style. A profile without any option (the 'vsicurl' default) sets nothing, as before.
+
+    def __init__(self, name, scheme='vsicurl', region=None, access='unsigned', endpoint=None, https=True,
+                 multiplex=None, mergeRanges=None, vsiCacheMB=None, allowedExtensions=None):
+        self.m_name = name
+        self.m_scheme = scheme.lower()
+        if self.m_scheme not in ('vsicurl', 'vsis3'):
+            raise ValueError('Unknown source scheme ' + scheme)
+        self.m_access = access.lower()
+        if self.m_access not in ('unsigned', 'requester-pays', 'signed'):
+            raise ValueError('Unknown S3 access ' + access)
+        self.m_region = region
+        self.m_endpoint = endpoint
+        self.m_https = https
+        self.m_multiplex = multiplex
+        self.m_merge_ranges = mergeRanges
+        self.m_vsi_cache_mb = vsiCacheMB
+        self.m_allowed_extensions = allowedExtensions
+
+    @classmethod
+    def fromDict(cls, name, values):
+        # values: {'Scheme': 'vsis3', 'Region': ..., 'Access': ..., 'Endpoint': ..., 'HTTPS': 'YES', 'Multiplex': 'YES',
+        # 'MergeRanges': 'YES', 'VsiCacheMB': '64', 'AllowedExtensions': '.tif'}, as read from <SourceProfiles>.
+        def flag(key):
+            return None if values.get(key) is None else values[key].strip().upper() in ('YES', 'TRUE', '1', 'ON')
+        return cls(name, values.get('Scheme', 'vsicurl'), values.get('Region'), values.get('Access', 'unsigned'),
+                   values.get('Endpoint'), flag('HTTPS') is not False, flag('Multiplex'), flag('MergeRanges'),
+                   None if values.get('VsiCacheMB') is None else float(values['VsiCacheMB']), values.get('AllowedExtensions'))
+
+    def source(self, url):
+        # GDAL path of a COG (or of a scene folder, ending in '/') given by its URL.
+        if self.m_scheme == 'vsis3':
+            location = s3Location(url, self.m_endpoint)
+            if location is not None:
+                return '/vsis3/' + location[0] + '/' + location[1]
+        return '/vsicurl/' + url
+
+    def url(self, source):
+        # the URL back from a source path written by any profile, None for paths this module does not write.
+        if source.startswith('/vsicurl/'):
+            return source[len('/vsicurl/'):]
+        if source.startswith('/vsis3/'):
+            bucket, _, key = source[len('/vsis3/'):].partition('/')
+            if self.m_endpoint is not None:
+                return '{}://{}/{}/{}'.format('https' if self.m_https else 'http', self.m_endpoint, bucket, key)
+            return 'https://{}.s3.{}.amazonaws.com/{}'.format(bucket, self.m_region or 'us-west-2', key)
+        return None
+
+    def config(self):
+        options = {}
+        if self.m_scheme == 'vsis3':
+            if self.m_region:
+                options['AWS_REGION'] = self.m_region
+            if self.m_access == 'unsigned':
+                options['AWS_NO_SIGN_REQUEST'] = 'YES'
+            else:
+                options['AWS_NO_SIGN_REQUEST'] = 'NO'
+                if self.m_access == 'requester-pays':
+                    options['AWS_REQUEST_PAYER'] = 'requester'
+            if self.m_endpoint:
+                options['AWS_S3_ENDPOINT'] = self.m_endpoint
+                options['AWS_VIRTUAL_HOSTING'] = 'FALSE'
+                options['AWS_HTTPS'] = 'YES' if self.m_https else 'NO'
+        if self.m_multiplex is not None:
+            options['GDAL_HTTP_MULTIPLEX'] = 'YES' if self.m_multiplex else 'NO'
+        if self.m_merge_ranges is not None:
+            options['GDAL_HTTP_MERGE_CONSECUTIVE_RANGES'] = 'YES' if self.m_merge_ranges else 'NO'
+        if self.m_vsi_cache_mb:
+            options['VSI_CACHE'] = 'TRUE'
+            options['VSI_CACHE_SIZE'] = str(int(self.m_vsi_cache_mb * 1048576))
+        if self.m_allowed_extensions:
+            options['CPL_VSIL_CURL_ALLOWED_EXTENSIONS'] = self.m_allowed_extensions
+            options['GDAL_DISABLE_READDIR_ON_OPEN'] = 'EMPTY_DIR'
+        return options
+
+    def apply(self, environ=None):
+        # sets the options in the environment (GDAL in this process, ArcGIS and child processes read them from there)
+        # and, when the bindings are loaded, as GDAL config options. Returns the previous values for restore().
+        environ = os.environ if environ is None else environ
+        previous = {}
+        for key, value in self.config().items():
+            previous[key] = environ.get(key)
+            environ[key] = value
+            if gdal is not None:
+                gdal.SetConfigOption(key, value)
+        return previous
+
+    @staticmethod
+    def restore(previous, environ=None):
+        environ = os.environ if environ is None else environ
+        for key, value in previous.items():
+            if value is None:
+                environ.pop(key, None)
+            else:
+                environ[key] = value
+            if gdal is not None:
+                gdal.SetConfigOption(key, value)
+
+
+CSOURCE_PROFILES = {
+    'vsicurl': {},
+    'vsicurl-tuned': {'Multiplex': 'YES', 'MergeRanges': 'YES', 'VsiCacheMB': '64', 'AllowedExtensions': '.tif,.TIF'},
+    's3-unsigned': {'Scheme': 'vsis3', 'Region': 'us-west-2', 'Access': 'unsigned', 'Multiplex': 'YES',
+                    'MergeRanges': 'YES', 'VsiCacheMB': '64', 'AllowedExtensions': '.tif,.TIF'},
+    's3-requester-pays': {'Scheme': 'vsis3', 'Region': 'us-west-2', 'Access': 'requester-pays', 'Multiplex': 'YES',
+                          'MergeRanges': 'YES', 'VsiCacheMB': '64', 'AllowedExtensions': '.tif,.TIF'},
+}
+
+
+# the original descriptors cut the first 55 characters off the product URL to form the cache path, i.e. this prefix
+# for earth-search items (.../sentinel-s2-l2a-cogs/13/S/DA/... -> <root>el-s2-l2a-cogs/13/S/DA/...). Kept as the
+# default <mrf_cache_strip> so existing caches stay valid.
+CLEGACY_CACHE_STRIP = 'https://sentinel-cogs.s3.us-west-2.amazonaws.com/sentin'
+
+CMRF_TEMPLATE = (
+    '<MRF_META>\n'
+    '  <CachedSource>\n'
+    '    <Source>{source}</Source>\n'
+    '  </CachedSource>\n'
+    '  <Raster>\n'
+    '    <Size c="1" x="{size}" y="{size}"/>\n'
+    '    <PageSize c="1" x="{page}" y="{page}"/>\n'
+    '    <Compression>{compression}</Compression>\n'
+    '    <DataType>{dataType}</DataType>\n'
+    '  <DataFile>{cache}.mrf_cache</DataFile><IndexFile>{cache}.mrf_cache</IndexFile></Raster>\n'
+    '  <Rsets model="uniform" scale="{rsetScale}"/>\n'
+    '  <GeoTags>\n'
+    '    <BoundingBox maxx="{maxX}" maxy="{maxY}" minx="{minX}" miny="{minY}"/>\n'
+    '    <Projection>{srs}</Projection>\n'
+    '  </GeoTags>\n'
+    '  <Options>V2=ON</Options>\n'
+    '</MRF_META>\n')
+_CMRF_DYNAMIC = ('source', 'cache', 'maxX', 'maxY', 'minX', 'minY', 'srs')
+
+
+class MRFTemplate(object):
+    # renders the caching MRF descriptor of a band. The per band static text (size, page size, compression, data
+    # type from BAND_INFO) is filled in once and split around the per scene values, so render() only concatenates.
+    # The cache key of a scene is the product URL with stripPrefix removed, or the URL path when no prefix is given.
+    # cacheRoot is one folder or several separated by ';', each optionally weighted as <folder>*<weight>. A scene is
+    # placed on one root by weighted rendezvous hashing of its key, so the mapping is stable and adding a root only
+    # moves the scenes that now rank it first. The source path comes from profile (SourceProfile, /vsicurl/ by
+    # default), the cache key always from the URL so switching profiles keeps the caches. Layouts:
+    #   mirror  <root><cache key><band>.mrf_cache, the key path as is (the original layout)
+    #   hash    <root>ab/cd/<scene>/<band>.mrf_cache, ab/cd from the SHA-1 of the key, <scene> its last folder name
+
+    def __init__(self, cacheRoot, stripPrefix=None, bandInfo=None, layout='mirror', profile=None):
+        self.m_profile = SourceProfile('vsicurl') if profile is None else profile
+        self.m_roots = parseCacheRoots(cacheRoot)
+        self.m_cache_root = self.m_roots[0][0]
+        self.m_strip = stripPrefix
+        self.m_layout = layout.lower()
+        if self.m_layout not in ('mirror', 'hash'):
+            raise ValueError('Unknown MRF cache layout ' + layout)
+        self.m_last = (None, None, None)
+        self.m_band_info = BAND_INFO if bandInfo is None else bandInfo
+        self.m_parts = {}
+        for band, info in self.m_band_info.items():
+            marked = CMRF_TEMPLATE.format(**dict(info, **dict((name, '\0' + name + '\0') for name in _CMRF_DYNAMIC)))
+            pieces = marked.split('\0')
+            # pieces alternate static text and dynamic field names, render() relies on the _CMRF_DYNAMIC order.
+            assert tuple(pieces[1::2]) == ('source', 'cache', 'cache', 'maxX', 'maxY', 'minX', 'minY', 'srs')
+            static = pieces[0::2]
+            static[1] = '.tif' + static[1]      # the band COG is the source of productUrl + band + '.tif'
+            self.m_parts[band] = static
+
+    def cacheKey(self, productUrl):
+        if self.m_strip is not None and productUrl.startswith(self.m_strip):
+            key = productUrl[len(self.m_strip):]
+        else:
+            key = productUrl.split('://', 1)[-1].split('/', 1)[-1]     # drop scheme and host
+        key = key.lstrip('/')
+        return key if key.endswith('/') or key == '' else key + '/'
+
+    def cacheRoot(self, key):
+        if len(self.m_roots) == 1:
+            return self.m_roots[0][0]
+        best = None
+        for root, weight in self.m_roots:
+            u = (int(hashlib.sha1((root + '|' + key).encode('utf-8')).hexdigest()[:15], 16) + 0.5) / 16 ** 15
+            score = -weight / math.log(u)
+            if best is None or score > best[0]:
+                best = (score, root)
+        return best[1]
+
+    def scene(self, productUrl):
+        # (cache folder, source path) of a scene, the bands of a scene are rendered one after the other.
+        if self.m_last[0] != productUrl:
+            self.m_last = (productUrl, self._cacheDir(productUrl), self.m_profile.source(productUrl))
+        return self.m_last[1], self.m_last[2]
+
+    def cacheDir(self, productUrl):
+        return self.scene(productUrl)[0]
+
+    def _cacheDir(self, productUrl):
+        key = self.cacheKey(productUrl)
+        root = self.cacheRoot(key)
+        if self.m_layout == 'hash':
+            h = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            folder = root + h[:2] + '/' + h[2:4] + '/' + key.rstrip('/').rsplit('/', 1)[-1] + '/'
+        else:
+            folder = root + key
+        return folder
+
+    def cachePath(self, productUrl, band):
+        return self.cacheDir(productUrl) + band
+
+    def rewrite(self, descriptor):
+        # points an existing caching MRF descriptor at this layout and source profile. Returns (text, old cache file,
+        # new cache file), the text is unchanged when the descriptor already matches or is not a caching MRF of a band COG.
+        start = descriptor.find('<Source>')
+        oldCache = mrfDataFile(descriptor)
+        if start < 0 or oldCache is None:
+            return descriptor, None, None
+        oldSource = descriptor[start + len('<Source>'):descriptor.index('</Source>', start)]
+        url = self.m_profile.url(oldSource)
+        if url is None or not url.endswith('.tif'):
+            return descriptor, None, None
+        band = url.rsplit('/', 1)[-1][:-len('.tif')]
+        productUrl = url[:-len(band + '.tif')]
+        folder, source = self.scene(productUrl)
+        newCache = folder + band + '.mrf_cache'
+        newSource = source + band + '.tif'
+        if newCache == oldCache and newSource == oldSource:
+            return descriptor, oldCache, newCache
+        text = descriptor.replace('<Source>' + oldSource + '</Source>', '<Source>' + newSource + '</Source>')
+        return text.replace(oldCache, newCache), oldCache, newCache
+
+    def render(self, productUrl, maxX, maxY, minX, minY, srs, band):
+        # productUrl: scene folder URL ending in '/', the band COG is productUrl + band + '.tif'.
+        s = self.m_parts[band]
+        folder, source = self.scene(productUrl)
+        cache = folder + band
+        return (s[0] + source + band + s[1] + cache + s[2] + cache + s[3] + str(maxX) + s[4] + str(maxY) + s[5] +
+                str(minX) + s[6] + str(minY) + s[7] + srs + s[8])
+
+    def format(self, productUrl, maxX, maxY, minX, minY, srs, band):
+        # the same descriptor through a full str.format of the template (the original per call path), for comparison.
+        return CMRF_TEMPLATE.format(source=self.m_profile.source(productUrl + band + '.tif'), cache=self.cachePath(productUrl, band),
+                                    maxX=maxX, maxY=maxY, minX=minX, minY=minY, srs=srs, **self.m_band_info[band])
+
+
+def parseCacheRoots(text):
+    # 'C:/mrfcache/cachingmrf/*2;D:/mrfcache/' -> [('C:/mrfcache/cachingmrf/', 2.0), ('D:/mrfcache/', 1.0)]
+    roots = []
+    for part in text.split(';'):
+        part = part.strip()
+        if not part:
+            continue
+        weight = 1.0
+        if '*' in part:
+            part, weight = part.rsplit('*', 1)
+            weight = float(weight)
+        roots.append((part if part.endswith(('/', '\\')) else part + '/', weight))
+    if not roots:
+        raise ValueError('No MRF cache root given')
+    return roots
+
+
+def moveCacheFile(oldPath, newPath):
+    # moves a cache file to its new layout location, returns False when there is nothing to move or the target exists.
+    if oldPath == newPath or not os.path.exists(oldPath) or os.path.exists(newPath):
+        return False
+    os.makedirs(os.path.dirname(newPath), exist_ok=True)
+    shutil.move(oldPath, newPath)       # a rename on the same volume, copy and delete across volumes
+    return True
+
+
+CPREWARM_GDAL_CONFIG = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif',
+    'GDAL_HTTP_MULTIRANGE': 'YES',          # neighbouring tile ranges of a COG are fetched in one request
+    'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+    'GDAL_HTTP_MAX_RETRY': '3',
+    'GDAL_HTTP_RETRY_DELAY': '1',
+}
+
+
+def mrfDataFile(descriptor):
+    # the <DataFile> of a caching MRF descriptor (text), None when there is none.
+    start = descriptor.find('<DataFile>')
+    if start < 0:
+        return None
+    return descriptor[start + len('<DataFile>'):descriptor.index('</DataFile>', start)]
+
+
+def pageWindows(width, height, pageX, pageY):
+    # (xOff, yOff, xSize, ySize) of every page of a raster level, row by row, the edge pages clipped.
+    return [(xOff, yOff, min(pageX, width - xOff), min(pageY, height - yOff))
+            for yOff in range(0, height, pageY) for xOff in range(0, width, pageX)]
+
+
+def gdalLevels(path):
+    # CachePrewarmer opener over GDAL: the levels of the caching MRF descriptor at path as
+    # [(width, height, pageX, pageY, read(xOff, yOff, xSize, ySize)) or None, ...], index 0 the full resolution.
+    ds = gdal.Open(path)
+    if ds is None:
+        raise IOError('Unable to open ' + path)
+    band = ds.GetRasterBand(1)
+    levels = []
+    for target in [band] + [band.GetOverview(i) for i in range(band.GetOverviewCount())]:
+        if target is None:
+            levels.append(None)
+            continue
+        pageX, pageY = target.GetBlockSize()
+        # the closure keeps ds open for as long as the levels are used.
+        levels.append((target.XSize, target.YSize, pageX, pageY,
+                       lambda xOff, yOff, xSize, ySize, target=target, ds=ds: target.ReadRaster(xOff, yOff, xSize, ySize)))
+    return levels
+
+
+class CachePrewarmer(object):
+    # fills the .mrf_cache files of caching MRF descriptors by reading their pages through GDAL, which fetches the
+    # missing tiles from the source COG with HTTP range requests and writes them to the cache. Descriptors are warmed
+    # concurrently (one worker per descriptor, so a cache file only has one writer), levels are given as Rsets levels
+    # (0 = full resolution, 1 = first overview, ...). The bytes added to the cache files are counted against budget,
+    # no new page is started once it is used up. Finished descriptors are recorded in statePath so an interrupted or
+    # budget-limited run resumes where it stopped, pages cached by a partial run are served from the cache.
+    # openLevels(path) returns the levels of a descriptor (see gdalLevels, the default). The page loop, budget and
+    # resume logic are tested without GDAL in tests/test_prewarm.py, the GDAL opener is experimental: its test is
+    # skipped without the GDAL bindings and still has to pass on a GDAL build before it is relied on.
+
+    def __init__(self, statePath, budget, workers=8, levels=(0,), openLevels=None):
+        self.m_state_path = statePath
+        self.m_open = gdalLevels if openLevels is None else openLevels
+        self.m_budget = budget
+        self.m_workers = max(1, int(workers))
+        self.m_levels = sorted(int(level) for level in levels)
+        self.m_bytes = 0
+        self.m_pages = 0
+        self.m_done = set()
+        self.m_lock = threading.Lock()
+        if statePath and os.path.exists(statePath):
+            with open(statePath, 'r') as f:
+                self.m_done = set(json.load(f).get('done', []))
+
+    def exhausted(self):
+        return self.m_budget is not None and self.m_bytes >= self.m_budget
+
+    def saveState(self):
+        if not self.m_state_path:
+            return
+        with self.m_lock:
+            state = {'done': sorted(self.m_done), 'bytes': self.m_bytes, 'updated': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
+        folder = os.path.dirname(self.m_state_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.m_state_path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.m_state_path)
+
+    def _cacheSize(self, dataFile):
+        try:
+            return os.path.getsize(dataFile)
+        except OSError:
+            return 0
+
+    def warm(self, path):
+        # path: caching MRF descriptor file. Returns True when every requested level was read completely.
+        with open(path, 'r') as f:
+            dataFile = mrfDataFile(f.read())
+        if dataFile:
+            os.makedirs(os.path.dirname(dataFile), exist_ok=True)
+        levels = self.m_open(path)
+        for level in self.m_levels:
+            if level >= len(levels) or levels[level] is None:
+                continue
+            width, height, pageX, pageY, read = levels[level]
+            for xOff, yOff, xSize, ySize in pageWindows(width, height, pageX, pageY):
+                if self.exhausted():
+                    return False
+                before = self._cacheSize(dataFile)
+                read(xOff, yOff, xSize, ySize)
+                with self.m_lock:
+                    self.m_bytes += self._cacheSize(dataFile) - before
+                    self.m_pages += 1
+        return True
+
+    def run(self, paths, log=None):
+        # paths: descriptor files. log(message) is called per descriptor. Returns (warmed, skipped, failed).
+        if self.m_open is gdalLevels:
+            if gdal is None:
+                raise ImportError('CachePrewarmer needs the GDAL python bindings (osgeo)')
+            for key, value in CPREWARM_GDAL_CONFIG.items():
+                if gdal.GetConfigOption(key) is None:
+                    gdal.SetConfigOption(key, value)
+        todo = [path for path in paths if path not in self.m_done]
+        counts = {'warmed': 0, 'failed': 0}
+
+        def job(path):
+            if self.exhausted():
+                return
+            try:
+                complete = self.warm(path)
+            except Exception as exp:
+                with self.m_lock:
+                    counts['failed'] += 1
+                if log is not None:
+                    log('{}: {}'.format(path, exp))
+                return
+            if complete:
+                with self.m_lock:
+                    self.m_done.add(path)
+                    counts['warmed'] += 1
+                if log is not None:
+                    log('warmed {} ({:.1f} MB cached so far)'.format(path, self.m_bytes / 1048576.0))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.m_workers) as pool:
+                list(pool.map(job, todo))
+        finally:
+            self.saveState()
+        return counts['warmed'], len(paths) - len(todo), counts['failed']
+
+    def report(self):
+        return 'prewarm: {} page(s) read, {:.1f} MB added to the cache{}'.format(
+            self.m_pages, self.m_bytes / 1048576.0, ', budget reached' if self.exhausted() else '')
+
+
+def vrtSources(vrt):
+    # {band description: SourceFilename} of a scene VRT written by sceneVRT.
+    sources = {}
+    for part in vrt.split('<VRTRasterBand')[1:]:
+        band = part[part.index('<Description>') + len('<Description>'):part.index('</Description>')]
+        start = part.index('>', part.index('<SourceFilename')) + 1
+        sources[band] = part[start:part.index('</SourceFilename>')]
+    return sources
+
+
+class CacheManager(object):
+    # size bound for the MRF cache folder. Every .mrf_cache file is tracked in a JSON index with its size, last
+    # access (newest of atime and mtime, writes happen whenever a tile is filled) and an access count that grows each
+    # time a scan sees a newer access, used by the 'lfu' policy. enforce() evicts until the folder fits the budget,
+    # least recently ('lru') or least frequently ('lfu', ties by age) used first. Files accessed within grace seconds
+    # are never evicted, and a file is first renamed out of the way so one the image service still holds open fails
+    # the rename and is kept.
+    # Reads of the image service are only seen through atime, the cache volume has to update it on reads (relatime is
+    # enough for the day scale of the grace window, noatime mounts and NTFS with last access updates disabled, the
+    # Windows default on large volumes, are not). Without it both policies only see when tiles were last filled,
+    # tracksAccess() checks this on the volume.
+
+    def __init__(self, root, indexPath, budget, policy='lru', grace=86400):
+        self.m_root = root
+        self.m_index_path = indexPath
+        self.m_budget = budget
+        self.m_policy = policy.lower()
+        self.m_grace = grace
+        self.m_index = {}
+        if indexPath and os.path.exists(indexPath):
+            with open(indexPath, 'r') as f:
+                self.m_index = json.load(f)
+
+    def scan(self):
+        files = {}
+        for folder, dirs, names in os.walk(self.m_root):
+            for name in names:
+                if not name.endswith('.mrf_cache'):
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                key = os.path.relpath(path, self.m_root).replace('\\', '/')
+                access = max(st.st_atime, st.st_mtime)
+                entry = self.m_index.get(key, {'hits': 0, 'access': 0})
+                hits = entry['hits'] + 1 if access > entry['access'] else entry['hits']
+                files[key] = {'size': st.st_size, 'access': access, 'hits': hits}
+        self.m_index = files
+        return files
+
+    def tracksAccess(self):
+        # True when reading a file under the root updates its access time: a probe file dated two days back is read
+        # and its atime checked, then removed.
+        probe = os.path.join(self.m_root, '.atime_probe.{}'.format(os.getpid()))
+        os.makedirs(self.m_root, exist_ok=True)
+        try:
+            with open(probe, 'wb') as f:
+                f.write(b'\0' * 16)
+            past = time.time() - 2 * 86400
+            os.utime(probe, (past, past))
+            with open(probe, 'rb') as f:
+                f.read()
+            return os.stat(probe).st_atime > past + 1
+        finally:
+            try:
+                os.remove(probe)
+            except OSError:
+                pass
+
+    def total(self):
+        return sum(entry['size'] for entry in self.m_index.values())
+
+    def usage(self):
+        # {'scene': {scene folder: bytes}, 'band': {band: bytes}}, a cache file is <scene folder>/<band>.mrf_cache.
+        scenes = {}
+        bands = {}
+        for key, entry in self.m_index.items():
+            scene, _, name = key.rpartition('/')
+            band = name[:-len('.mrf_cache')]
+            scenes[scene] = scenes.get(scene, 0) + entry['size']
+            bands[band] = bands.get(band, 0) + entry['size']
+        return {'scene': scenes, 'band': bands}
+
+    def candidates(self, now=None):
+        now = time.time() if now is None else now
+        keys = [key for key, entry in self.m_index.items() if now - entry['access'] > self.m_grace]
+        if self.m_policy == 'lfu':
+            keys.sort(key=lambda key: (self.m_index[key]['hits'], self.m_index[key]['access']))
+        else:
+            keys.sort(key=lambda key: self.m_index[key]['access'])
+        return keys
+
+    def _remove(self, key):
+        path = os.path.join(self.m_root, key)
+        evicted = '{}.{}.evict'.format(path, os.getpid())
+        try:
+            os.rename(path, evicted)
+        except OSError:
+            return False        # in use (Windows refuses to rename open files) or already gone
+        try:
+            os.remove(evicted)
+        except OSError:
+            pass
+        folder = os.path.dirname(path)
+        while folder != self.m_root and folder.startswith(self.m_root):
+            try:
+                os.rmdir(folder)        # only succeeds on empty folders
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+        return True
+
+    def enforce(self, now=None):
+        # returns (files evicted, bytes freed, bytes still over budget)
+        total = self.total()
+        evicted = 0
+        freed = 0
+        for key in self.candidates(now):
+            if total <= self.m_budget:
+                break
+            size = self.m_index[key]['size']
+            if self._remove(key):
+                del self.m_index[key]
+                total -= size
+                freed += size
+                evicted += 1
+        return evicted, freed, max(0, total - self.m_budget)
+
+    def save(self):
+        folder = os.path.dirname(self.m_index_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.m_index_path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.m_index, f)
+        os.replace(tmp, self.m_index_path)
+
+
+_CTIFF_TYPES = {1: 'u1', 2: 'u1', 3: 'u2', 4: 'u4', 5: 'u4', 6: 'i1', 7: 'u1', 8: 'i2', 9: 'i4', 10: 'i4', 11: 'f4',
+                12: 'f8', 16: 'u8', 17: 'i8', 18: 'u8'}
+_CTIFF_TAGS = {254: 'subfileType', 256: 'width', 257: 'height', 259: 'compression', 317: 'predictor',
+               322: 'tileWidth', 323: 'tileHeight', 324: 'offsets', 325: 'counts'}
+CTILE_DTYPE = np.dtype([('offset', '<u8'), ('count', '<u4')])
+
+
+class _RangeBuffer(object):
+    # the leading bytes of a remote file, grown on demand (COG headers and tile tables sit at the start of the file).
+
+    def __init__(self, fetch, size):
+        self.m_fetch = fetch
+        self.m_data = fetch(0, size)
+        self.m_requests = 1
+
+    def get(self, offset, length):
+        end = offset + length
+        if end > len(self.m_data):
+            more = self.m_fetch(len(self.m_data), max(end, 2 * len(self.m_data)))
+            self.m_requests += 1
+            if not more:
+                raise ValueError('TIFF structure beyond the end of the file')
+            self.m_data += more
+        return self.m_data[offset:end]
+
+
+def readTiffIndex(fetch, headerSize=65536):
+    # fetch(start, end) -> bytes [start, end) of the file, may return fewer bytes at the end of the file.
+    # Returns ([{'width', 'height', 'tileWidth', 'tileHeight', 'compression', 'predictor', 'offsets', 'counts'}, ...],
+    # requests) for the full resolution image and its overviews, in file order. Classic TIFF and BigTIFF, tiled only.
+    buf = _RangeBuffer(fetch, headerSize)
+    order = buf.get(0, 2)
+    if order not in (b'II', b'MM'):
+        raise ValueError('Not a TIFF file')
+    e = '<' if order == b'II' else '>'
+    version = int(np.frombuffer(buf.get(2, 2), e + 'u2')[0])
+    big = version == 43
+    if big:
+        ifd = int(np.frombuffer(buf.get(8, 8), e + 'u8')[0])
+    elif version == 42:
+        ifd = int(np.frombuffer(buf.get(4, 4), e + 'u4')[0])
+    else:
+        raise ValueError('Unknown TIFF version {}'.format(version))
+    countType, entrySize, offsetType, inline = ('u8', 20, 'u8', 8) if big else ('u2', 12, 'u4', 4)
+    levels = []
+    while ifd:
+        countSize = 8 if big else 2
+        entries = int(np.frombuffer(buf.get(ifd, countSize), e + countType)[0])
+        table = buf.get(ifd + countSize, entries * entrySize)
+        tags = {}
+        for i in range(entries):
+            entry = table[i * entrySize:(i + 1) * entrySize]
+            tag, typ = np.frombuffer(entry[:4], e + 'u2')
+            name = _CTIFF_TAGS.get(int(tag))
+            if name is None or int(typ) not in _CTIFF_TYPES:
+                continue
+            count = int(np.frombuffer(entry[4:4 + (8 if big else 4)], e + ('u8' if big else 'u4'))[0])
+            dtype = np.dtype(e + _CTIFF_TYPES[int(typ)])
+            size = count * dtype.itemsize
+            valueField = entry[entrySize - inline:]
+            raw = valueField[:size] if size <= inline else buf.get(int(np.frombuffer(valueField, e + offsetType)[0]), size)
+            tags[name] = np.frombuffer(raw, dtype, count)
+        ifd = int(np.frombuffer(buf.get(ifd + countSize + entries * entrySize, inline), e + offsetType)[0])
+        if 'offsets' not in tags or 'tileWidth' not in tags:
+            raise ValueError('Only tiled TIFFs can be indexed')
+        if int(tags.get('subfileType', [0])[0]) & 4:
+            continue        # transparency mask
+        levels.append({'width': int(tags['width'][0]), 'height': int(tags['height'][0]),
+                       'tileWidth': int(tags['tileWidth'][0]), 'tileHeight': int(tags['tileHeight'][0]),
+                       'compression': int(tags.get('compression', [1])[0]), 'predictor': int(tags.get('predictor', [1])[0]),
+                       'offsets': tags['offsets'].astype(np.uint64), 'counts': tags['counts'].astype(np.uint32)})
+    return levels, buf.m_requests
+
+
+class CogIndex(object):
+    # per scene tile index of the band COGs: <root>/ab/<scene>.npy holds (offset, count) of every tile of every level
+    # of every band (memory mapped on load), <root>/ab/<scene>.json the level layout and each level's first row, so a
+    # tile is found by position without any search.
+
+    def __init__(self, root):
+        self.m_root = root
+
+    def path(self, productUrl):
+        scene = productUrl.rstrip('/').rsplit('/', 1)[-1]
+        return os.path.join(self.m_root, hashlib.sha1(productUrl.encode('utf-8')).hexdigest()[:2], scene)
+
+    def exists(self, productUrl):
+        return os.path.exists(self.path(productUrl) + '.json')
+
+    def build(self, productUrl, fetchBand, bands=None):
+        # fetchBand(url) -> fetch(start, end) for that URL. Returns the number of header requests made.
+        bands = BANDS if bands is None else bands
+        meta = {'productUrl': productUrl, 'bands': {}}
+        tables = []
+        row = 0
+        requests = 0
+        for band in bands:
+            levels, made = readTiffIndex(fetchBand(productUrl + band + '.tif'))
+            requests += made
+            meta['bands'][band] = []
+            for level in levels:
+                table = np.zeros(len(level['offsets']), CTILE_DTYPE)
+                table['offset'] = level['offsets']
+                table['count'] = level['counts']
+                tables.append(table)
+                meta['bands'][band].append(dict((k, v) for k, v in level.items() if k not in ('offsets', 'counts')))
+                meta['bands'][band][-1]['start'] = row
+                row += len(table)
+        path = self.path(productUrl)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path + '.tmp.npy', np.concatenate(tables) if tables else np.zeros(0, CTILE_DTYPE))
+        os.replace(path + '.tmp.npy', path + '.npy')
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.json.tmp', path + '.json')
+        return requests
+
+    def load(self, productUrl):
+        path = self.path(productUrl)
+        with open(path + '.json', 'r') as f:
+            meta = json.load(f)
+        return meta, np.load(path + '.npy', mmap_mode='r')
+
+
+class TileReader(object):
+    # serves raw (still compressed) COG tiles from a CogIndex with a single range request per tile.
+
+    def __init__(self, index, productUrl, fetchBand):
+        self.m_meta, self.m_tiles = index.load(productUrl)
+        self.m_product_url = productUrl
+        self.m_fetch_band = fetchBand
+
+    def level(self, band, level):
+        return self.m_meta['bands'][band][level]
+
+    def readTile(self, band, level, col, row):
+        # returns (bytes, level info), bytes is empty for a sparse (never written) tile.
+        info = self.level(band, level)
+        across = (info['width'] + info['tileWidth'] - 1) // info['tileWidth']
+        tile = self.m_tiles[info['start'] + row * across + col]
+        offset, count = int(tile['offset']), int(tile['count'])
+        if count == 0:
+            return b'', info
+        return self.m_fetch_band(self.m_product_url + band + '.tif')(offset, offset + count), info
+
+
+def httpRangeFetcher(session, timeout=30):
+    # fetchBand for CogIndex/TileReader over a requests session: url -> fetch(start, end) with one Range request.
+    def fetchBand(url):
+        def fetch(start, end):
+            response = session.get(url, headers={'Range': 'bytes={}-{}'.format(start, end - 1)}, timeout=timeout)
+            if response.status_code == 416:
+                return b''
+            response.raise_for_status()
+            if response.status_code != 206 and start > 0:
+                return response.content[start:end]      # server ignored the range
+            return response.content[:end - start]
+        return fetch
+    return fetchBand
+
+
+CAGE_BUCKETS = [('1d', 86400), ('7d', 7 * 86400), ('30d', 30 * 86400), ('90d', 90 * 86400), ('older', None)]
+
+
+def mrfPageCount(size, page=512, scale=2):
+    # pages of a square caching MRF over all its Rsets levels, down to the level that fits one page.
+    pages = 0
+    while True:
+        across = (size + page - 1) // page
+        pages += across * across
+        if across <= 1:
+            return pages
+        size = (size + scale - 1) // scale
+
+
+def mrfIndexPages(path):
+    # filled pages of an MRF data file counted from its separate index (<name>.idx, one big endian offset/size pair
+    # per page, size 0 for pages not fetched yet). None when there is no separate index, as for the single file V2
+    # caches the descriptors write (IndexFile = DataFile).
+    indexPath = os.path.splitext(path)[0] + '.idx'
+    if not os.path.exists(indexPath):
+        return None
+    index = np.fromfile(indexPath, '>u8')
+    return int(np.count_nonzero(index[1:len(index) // 2 * 2:2]))
+
+
+def cacheTelemetry(files, mapping, pageRatio=0.5, now=None):
+    # files: {path: {'size', 'access', 'hits'}} of the cache files (CacheManager index entries with full paths).
+    # mapping: {path: (scene, band)} from the BandTiles descriptors, unmapped files fall back to <folder>/<band>.
+    # Pages are counted from the MRF index where the cache has a separate one (pagesIndexed) and otherwise estimated
+    # from the bytes on disk with an average compressed page of pageRatio of the raw page (pagesEstimated), the
+    # cached share is derived from both and is only exact when pagesEstimated is 0.
+    now = time.time() if now is None else now
+    bands = {}
+    scenes = {}
+    ages = dict((name, {'files': 0, 'bytes': 0}) for name, limit in CAGE_BUCKETS)
+    for path, entry in files.items():
+        scene, band = mapping.get(path, (None, None))
+        if band is None:
+            folder, name = os.path.split(path)
+            scene, band = os.path.basename(folder), name.split('.')[0]
+        info = BAND_INFO.get(band, {'size': BAND_SIZE['B02'], 'page': 512, 'rsetScale': 2})
+        total = mrfPageCount(info['size'], info['page'], info['rsetScale'])
+        indexed = mrfIndexPages(path)
+        estimated = 0
+        if indexed is None:
+            indexed = 0
+            pageBytes = info['page'] * info['page'] * 2 * pageRatio      # UInt16
+            estimated = min(total, int(math.ceil(entry['size'] / pageBytes))) if entry['size'] else 0
+        for table, key in ((bands, band), (scenes, scene)):
+            stats = table.setdefault(key, {'files': 0, 'bytes': 0, 'pagesIndexed': 0, 'pagesEstimated': 0, 'pagesTotal': 0})
+            stats['files'] += 1
+            stats['bytes'] += entry['size']
+            stats['pagesIndexed'] += indexed
+            stats['pagesEstimated'] += estimated
+            stats['pagesTotal'] += total
+        age = now - entry['access']
+        for name, limit in CAGE_BUCKETS:
+            if limit is None or age <= limit:
+                ages[name]['files'] += 1
+                ages[name]['bytes'] += entry['size']
+                break
+    for table in (bands, scenes):
+        for stats in table.values():
+            pages = stats['pagesIndexed'] + stats['pagesEstimated']
+            stats['cachedPctEstimated'] = round(100.0 * pages / stats['pagesTotal'], 2) if stats['pagesTotal'] else 0.0
+    return {'generated': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), 'files': len(files),
+            'bytes': sum(entry['size'] for entry in files.values()), 'pageRatio': pageRatio,
+            'band': bands, 'scene': scenes, 'age': ages}
+
+
+class SceneLedger(object):
+    # append-only list of the product URLs of every scene ingested, one per line. BandTiles and a non incremental
+    # MasterTiles only hold the last run, the ledger lets the cache telemetry name the scenes of all earlier runs.
+
+    def __init__(self, path):
+        self.m_path = path
+
+    def urls(self):
+        if not os.path.exists(self.m_path):
+            return []
+        with open(self.m_path, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def add(self, urls):
+        known = set(self.urls())
+        new = [url for url in dict.fromkeys(urls) if url not in known]
+        if new:
+            os.makedirs(os.path.dirname(self.m_path), exist_ok=True)
+            with open(self.m_path, 'a') as f:
+                f.write(''.join(url + '\n' for url in new))
+        return len(new)
+
+
+def sceneName(productUrl):
+    # https://.../S2B_13SDA_20230701_0_L2A/ -> S2B_13SDA_20230701_0_L2A (the STAC item id)
+    return productUrl.rstrip('/').rsplit('/', 1)[-1]
+
+
+def prometheusText(report):
+    # node_exporter textfile collector format. Per band and per age bucket only, scenes stay in the JSON report.
+    lines = []
+
+    def metric(name, help, samples):
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} gauge'.format(name))
+        for labels, value in samples:
+            label = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+            lines.append('{}{} {}'.format(name, '{' + label + '}' if label else '', value))
+
+    bands = sorted(report['band'].items())
+    metric('mrf_cache_files', 'Cache files on disk.', [((), report['files'])])
+    metric('mrf_cache_bytes', 'Bytes on disk per band.', [((('band', b),), s['bytes']) for b, s in bands])
+    metric('mrf_cache_pages_indexed', 'Pages cached per band, counted from the MRF index files.', [((('band', b),), s['pagesIndexed']) for b, s in bands])
+    metric('mrf_cache_pages_estimated', 'Pages cached per band, estimated from the size of caches without an index file.', [((('band', b),), s['pagesEstimated']) for b, s in bands])
+    metric('mrf_cache_cached_ratio_estimated', 'Estimated share of the band rasters cached, indexed and estimated pages.', [((('band', b),), round(s['cachedPctEstimated'] / 100.0, 4)) for b, s in bands])
+    metric('mrf_cache_age_bytes', 'Bytes on disk by time since last access.', [((('age', a),), report['age'][a]['bytes']) for a, limit in CAGE_BUCKETS])
+    return '\n'.join(lines) + '\n'
+
+
+def writeAtomic(path, text):
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
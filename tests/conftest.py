@@ -0,0 +1,37 @@
+import os
+import sys
+import urllib.error
+import urllib.request
+
+import pytest
+
+# the helper modules live next to MDCS.py and import each other as top level modules.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+import sentinelBench
+
+
+@pytest.fixture
+def standIn(tmp_path):
+    server = sentinelBench.S3StandIn(str(tmp_path / 's3')).start()
+    yield server
+    server.stop()
+
+
+def urlFetchBand(url):
+    # fetchBand for CogIndex/TileReader over plain urllib, one Range request per call.
+    def fetch(start, end):
+        request = urllib.request.Request(url, headers={'Range': 'bytes={}-{}'.format(start, end - 1)})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.read()
+        except urllib.error.HTTPError as exp:
+            if exp.code == 416:
+                return b''
+            raise
+    return fetch
+
+
+@pytest.fixture
+def fetchBand():
+    return urlFetchBand
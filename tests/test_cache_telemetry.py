@@ -0,0 +1,24 @@
+import numpy as np
+
+import sentinelLib
+
+
+def test_pages_counted_from_index_or_estimated(tmp_path):
+    folder = tmp_path / 'S2B_13SDA_20230701_0_L2A'
+    folder.mkdir()
+    indexed = str(folder / 'B02.mrf_cache')
+    estimated = str(folder / 'B03.mrf_cache')
+    # offset/size pairs, two of the four pages filled.
+    np.array([0, 0, 512, 300, 0, 0, 900, 20], '>u8').tofile(str(folder / 'B02.idx'))
+    files = {indexed: {'size': 100000, 'access': 0, 'hits': 1}, estimated: {'size': 300000, 'access': 0, 'hits': 1}}
+    assert sentinelLib.mrfIndexPages(indexed) == 2
+    assert sentinelLib.mrfIndexPages(estimated) is None
+
+    report = sentinelLib.cacheTelemetry(files, {}, pageRatio=0.5)
+    assert (report['band']['B02']['pagesIndexed'], report['band']['B02']['pagesEstimated']) == (2, 0)
+    assert report['band']['B03']['pagesIndexed'] == 0
+    assert report['band']['B03']['pagesEstimated'] == 2      # 300000 bytes over 512 x 512 x 2 x 0.5 byte pages
+    assert report['scene']['S2B_13SDA_20230701_0_L2A']['files'] == 2
+    text = sentinelLib.prometheusText(report)
+    assert 'mrf_cache_pages_estimated{band="B03"} 2' in text
+    assert 'mrf_cache_cached_ratio_estimated' in text and 'bytes_saved' not in text
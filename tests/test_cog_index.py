@@ -0,0 +1,135 @@
+import os
+
+import numpy as np
+import pytest
+
+import sentinelLib
+
+
+def writeTiff(path, levels, big=False, order='<', mask=False, seed=0):
+    # synthetic tiled TIFF with the IFDs and tile tables ahead of the tile data, like a COG. levels: [(width, height,
+    # tile), ...], full resolution first. About one tile in ten is sparse (offset and byte count 0). With mask a
+    # transparency mask IFD follows the full resolution one. Returns the tile bytes per level as [[bytes, ...], ...].
+    rng = np.random.default_rng(seed)
+    ifds = []
+    for i, (width, height, tile) in enumerate(levels):
+        count = ((width + tile - 1) // tile) * ((height + tile - 1) // tile)
+        tiles = [b'' if rng.random() < 0.1 else rng.integers(0, 256, int(rng.integers(20, 400)), dtype=np.uint8).tobytes()
+                 for t in range(count)]
+        ifds.append((width, height, tile, 1 if i else 0, tiles))
+        if mask and i == 0:
+            ifds.append((width, height, tile, 4, [b'\0' * 10] * count))
+    offsetType, offsetCode, countCode = ('u8', 16, 'u8') if big else ('u4', 4, 'u4')
+    entrySize, inline, headerSize = (20, 8, 16) if big else (12, 4, 8)
+
+    def ifdSize(tiles):
+        external = sum(n * size for n, size in ((len(tiles), np.dtype(offsetType).itemsize), (len(tiles), 4)) if n * size > inline)
+        return (8 if big else 2) + 8 * entrySize + inline + external
+
+    position = headerSize
+    starts = []
+    for ifd in ifds:
+        starts.append(position)
+        position += ifdSize(ifd[4])
+    dataStart = position
+    out = bytearray()
+    out += (b'II' if order == '<' else b'MM')
+    out += np.array([43 if big else 42], order + 'u2').tobytes()
+    out += np.array([8, 0], order + 'u2').tobytes() + np.array([starts[0]], order + 'u8').tobytes() if big else \
+        np.array([starts[0]], order + 'u4').tobytes()
+    data = bytearray()
+    for index, (width, height, tile, subfile, tiles) in enumerate(ifds):
+        offsets = []
+        for content in tiles:
+            offsets.append(dataStart + len(data) if content else 0)
+            data += content
+        offsets = np.array(offsets, order + offsetType)
+        counts = np.array([len(content) for content in tiles], order + 'u4')
+        external = bytearray()
+        externalStart = starts[index] + (8 if big else 2) + 8 * entrySize + inline
+        entries = []
+        for tag, typ, values in ((254, 4, np.array([subfile], order + 'u4')), (256, 4, np.array([width], order + 'u4')),
+                                 (257, 4, np.array([height], order + 'u4')), (259, 3, np.array([8], order + 'u2')),
+                                 (322, 3, np.array([tile], order + 'u2')), (323, 3, np.array([tile], order + 'u2')),
+                                 (324, offsetCode, offsets), (325, 4, counts)):
+            raw = values.tobytes()
+            if len(raw) <= inline:
+                field = raw + b'\0' * (inline - len(raw))
+            else:
+                field = np.array([externalStart + len(external)], order + offsetType).tobytes()
+                external += raw
+            entries.append(np.array([tag, typ], order + 'u2').tobytes() +
+                           np.array([len(values)], order + countCode).tobytes() + field)
+        nextIfd = starts[index + 1] if index + 1 < len(ifds) else 0
+        out += np.array([len(entries)], order + ('u8' if big else 'u2')).tobytes() + b''.join(entries)
+        out += np.array([nextIfd], order + offsetType).tobytes() + external
+    assert len(out) == dataStart
+    with open(path, 'wb') as f:
+        f.write(out + data)
+    return [ifd[4] for ifd in ifds if ifd[3] != 4]
+
+
+CLEVELS = [(1500, 1200, 128), (750, 600, 128), (375, 300, 128)]
+CBANDS = ['B02', 'B03', 'B04']
+
+
+@pytest.mark.parametrize('big, order', [(False, '<'), (False, '>'), (True, '<'), (True, '>')])
+def test_readTiffIndex_roundtrip(tmp_path, big, order):
+    path = str(tmp_path / 'band.tif')
+    expected = writeTiff(path, CLEVELS, big, order, mask=True)
+    with open(path, 'rb') as f:
+        content = f.read()
+    # a small header buffer forces the tile tables to be fetched in further requests.
+    levels, requests = sentinelLib.readTiffIndex(lambda start, end: content[start:end], headerSize=256)
+    assert requests > 1
+    assert [(level['width'], level['height'], level['tileWidth']) for level in levels] == CLEVELS
+    for level, tiles in zip(levels, expected):
+        assert level['compression'] == 8
+        for offset, count, tile in zip(level['offsets'], level['counts'], tiles):
+            assert content[int(offset):int(offset) + int(count)] == tile
+
+
+def test_readTiffIndex_rejects_non_tiff():
+    with pytest.raises(ValueError):
+        sentinelLib.readTiffIndex(lambda start, end: b'GIF89a\0\0'[start:end])
+
+
+@pytest.mark.parametrize('big', [False, True])
+def test_tile_reader_over_http(tmp_path, standIn, fetchBand, big):
+    productUrl = 'http://{}/sentinel-cogs/S2B_13SDA_20230701_0_L2A/'.format(standIn.endpoint)
+    folder = os.path.join(standIn.m_root, 'sentinel-cogs', 'S2B_13SDA_20230701_0_L2A')
+    os.makedirs(folder)
+    expected = dict((band, writeTiff(os.path.join(folder, band + '.tif'), CLEVELS, big, seed=i))
+                    for i, band in enumerate(CBANDS))
+    index = sentinelLib.CogIndex(str(tmp_path / 'index'))
+    assert not index.exists(productUrl)
+    assert index.build(productUrl, fetchBand, CBANDS) == len(CBANDS)      # the 64 KB header covers each tile table
+    assert index.exists(productUrl)
+
+    reader = sentinelLib.TileReader(index, productUrl, fetchBand)
+    standIn.counters(reset=True)
+    tiles = sparse = 0
+    for band in CBANDS:
+        for level, (width, height, tile) in enumerate(CLEVELS):
+            across = (width + tile - 1) // tile
+            for i, content in enumerate(expected[band][level]):
+                data, info = reader.readTile(band, level, i % across, i // across)
+                assert data == content
+                assert info['tileWidth'] == tile
+                tiles += 1
+                sparse += content == b''
+    requests, sent = standIn.counters()
+    assert requests == tiles - sparse       # one request per stored tile, none for sparse ones
+
+
+def test_httpRangeFetcher(tmp_path, standIn):
+    requests = pytest.importorskip('requests')
+    folder = os.path.join(standIn.m_root, 'sentinel-cogs', 'scene')
+    os.makedirs(folder)
+    writeTiff(os.path.join(folder, 'B02.tif'), CLEVELS)
+    with open(os.path.join(folder, 'B02.tif'), 'rb') as f:
+        content = f.read()
+    fetch = sentinelLib.httpRangeFetcher(requests.Session())('http://{}/sentinel-cogs/scene/B02.tif'.format(standIn.endpoint))
+    assert fetch(10, 100) == content[10:100]
+    assert fetch(len(content) - 5, len(content) + 100) == content[-5:]
+    assert fetch(len(content) + 10, len(content) + 20) == b''
@@ -0,0 +1,143 @@
+import json
+import os
+
+import pytest
+
+import sentinelBench
+import sentinelLib
+
+from conftest import urlFetchBand
+
+CBAND_INFO = {'B05': {'size': 1024, 'page': 256, 'compression': 'DEFLATE', 'dataType': 'UInt16', 'rsetScale': 2}}
+
+
+def descriptors(tmp_path, standIn, scenes, stage=None):
+    # one band source per scene behind the stand-in (a synthetic COG by default) and a caching MRF descriptor file for each.
+    template = sentinelLib.MRFTemplate(str(tmp_path / 'cache') + '/', None, CBAND_INFO)
+    paths = []
+    for scene in scenes:
+        source = os.path.join(standIn.m_root, 'sentinel-cogs', scene, 'B05.tif')
+        if stage is None:
+            sentinelBench.stageBenchmarkCog(source, size=1024)
+        else:
+            stage(source)
+        productUrl = 'http://{}/sentinel-cogs/{}/'.format(standIn.endpoint, scene)
+        path = str(tmp_path / 'mrf' / (scene + '.mrf'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(template.render(productUrl, 10240, 10240, 0, 0, 'EPSG:32613', 'B05'))
+        paths.append(path)
+    return paths
+
+
+def stageRaw(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(65536))
+
+
+def cachingLevels(path):
+    # CachePrewarmer opener standing in for a caching MRF: the first read of a page range-fetches 64 bytes from the
+    # source and appends them to the data file, pages listed in <data file>.pages are read from the cache.
+    with open(path) as f:
+        descriptor = f.read()
+    dataFile = sentinelLib.mrfDataFile(descriptor)
+    source = descriptor[descriptor.index('<Source>') + len('<Source>'):descriptor.index('</Source>')]
+    fetch = urlFetchBand(source.replace('/vsicurl/', '', 1))
+    info = CBAND_INFO['B05']
+    levels = []
+    size = info['size']
+    while True:
+        level = len(levels)
+
+        def read(xOff, yOff, xSize, ySize, level=level):
+            key = '{}/{}/{}'.format(level, xOff, yOff)
+            listPath = dataFile + '.pages'
+            cached = open(listPath).read().split() if os.path.exists(listPath) else []
+            if key in cached:
+                return
+            offset = 64 * (len(cached) % 1000)
+            content = fetch(offset, offset + 64)
+            assert len(content) == 64
+            with open(dataFile, 'ab') as f:
+                f.write(content)
+            with open(listPath, 'a') as f:
+                f.write(key + '\n')
+
+        levels.append((size, size, info['page'], info['page'], read))
+        if size <= info['page']:
+            return levels
+        size = (size + info['rsetScale'] - 1) // info['rsetScale']
+
+
+def test_page_loop_budget_and_resume(tmp_path, standIn):
+    # the page loop, budget and resume logic over real range requests, without GDAL.
+    paths = descriptors(tmp_path, standIn, ['S2B_A_L2A', 'S2B_B_L2A'], stageRaw)
+    statePath = str(tmp_path / 'state.json')
+    pages = (16 + 4 + 1) * 2
+
+    limited = sentinelLib.CachePrewarmer(statePath, 1, workers=1, levels=[0], openLevels=cachingLevels)
+    assert limited.run(paths) == (0, 0, 0)
+    assert limited.exhausted() and limited.m_pages == 1 and standIn.counters()[0] == 1
+    with open(statePath) as f:
+        assert json.load(f)['done'] == []
+
+    standIn.counters(reset=True)
+    resumed = sentinelLib.CachePrewarmer(statePath, None, workers=2, levels=[0, 1, 2, 5], openLevels=cachingLevels)
+    assert resumed.run(paths) == (2, 0, 0)
+    assert resumed.m_pages == pages
+    assert standIn.counters()[0] == pages - 1       # the page cached by the limited run is not fetched again
+    assert resumed.m_bytes == 64 * (pages - 1)
+    for path in paths:
+        with open(path) as f:
+            assert os.path.getsize(sentinelLib.mrfDataFile(f.read())) == 64 * pages // 2
+    with open(statePath) as f:
+        assert json.load(f)['done'] == sorted(paths)
+
+    standIn.counters(reset=True)
+    again = sentinelLib.CachePrewarmer(statePath, None, workers=2, levels=[0, 1, 2], openLevels=cachingLevels)
+    assert again.run(paths) == (0, 2, 0)
+    assert standIn.counters()[0] == 0
+
+
+def test_page_windows_clip_the_edges():
+    assert sentinelLib.pageWindows(600, 300, 256, 256) == [
+        (0, 0, 256, 256), (256, 0, 256, 256), (512, 0, 88, 256),
+        (0, 256, 256, 44), (256, 256, 256, 44), (512, 256, 88, 44)]
+
+
+def test_warm_fills_cache_and_resumes(tmp_path, standIn):
+    pytest.importorskip('osgeo.gdal')
+    paths = descriptors(tmp_path, standIn, ['S2B_A_L2A', 'S2B_B_L2A'])
+    statePath = str(tmp_path / 'state.json')
+
+    # a one byte budget stops after the first page, nothing is recorded as done.
+    limited = sentinelLib.CachePrewarmer(statePath, 1, workers=1, levels=[0])
+    warmed, skipped, failed = limited.run(paths)
+    assert (warmed, failed) == (0, 0)
+    assert limited.exhausted() and limited.m_pages >= 1
+    with open(statePath) as f:
+        assert json.load(f)['done'] == []
+
+    # the next run finishes both descriptors and fills their cache files.
+    standIn.counters(reset=True)
+    resumed = sentinelLib.CachePrewarmer(statePath, None, workers=2, levels=[0, 1])
+    assert resumed.run(paths) == (2, 0, 0)
+    assert standIn.counters()[0] > 0
+    for path in paths:
+        with open(path) as f:
+            assert os.path.getsize(sentinelLib.mrfDataFile(f.read())) > 0
+    with open(statePath) as f:
+        assert json.load(f)['done'] == sorted(paths)
+
+    # finished descriptors are skipped without touching the source.
+    standIn.counters(reset=True)
+    again = sentinelLib.CachePrewarmer(statePath, None, workers=2, levels=[0, 1])
+    assert again.run(paths) == (0, 2, 0)
+    assert standIn.counters()[0] == 0
+
+    # pages already cached are read back without fetching from the source.
+    standIn.counters(reset=True)
+    cached = sentinelLib.CachePrewarmer(None, None, workers=1, levels=[0, 1])
+    assert cached.run(paths[:1]) == (1, 0, 0)
+    assert standIn.counters()[0] == 0
@@ -0,0 +1,30 @@
+import sentinelLib
+
+
+def item(itemId, productUri, updated=''):
+    return {'id': itemId, 'properties': {'s2:product_uri': productUri, 'updated': updated}}
+
+
+CPRODUCT = 'S2B_MSIL2A_20230701T174909_{}_R141_T13SDA_{}.SAFE'
+
+
+def test_newest_reprocessing_is_held_back_until_flush():
+    index = sentinelLib.SceneIndex(dedupeProduct=True)
+    assert index.accept(item('a', None))                   # no product key, written right away
+    assert not index.accept(item('a', None))               # duplicate id
+    assert not index.accept(item('old', CPRODUCT.format('N0509', '20230702T001234')))
+    assert not index.accept(item('new', CPRODUCT.format('N0510', '20240101T000000')))
+    assert not index.accept(item('older', CPRODUCT.format('N0400', '20230702T001234')))
+    assert [i['id'] for i in index.flush()] == ['new']
+    assert index.flush() == []
+    assert index.m_dropped == 3
+
+
+def test_existing_rows_are_superseded_by_newer_reprocessings_only():
+    index = sentinelLib.SceneIndex(dedupeProduct=True)
+    index.addExisting('kept', CPRODUCT.format('N0509', '20230702T001234'), 7)
+    index.addExisting('other', 'S2B_MSIL2A_20230706T174909_N0509_R141_T13SDA_20230706T001234.SAFE', 8)
+    assert not index.accept(item('same', CPRODUCT.format('N0509', '20230702T001234')))
+    assert not index.accept(item('newer', CPRODUCT.format('N0510', '20240101T000000')))
+    assert [i['id'] for i in index.flush()] == ['newer']
+    assert index.m_superseded == [7]